@@ -1,22 +1,30 @@
-from datetime import datetime
-from io import BytesIO
+from datetime import date, datetime
+from html import escape
 import re
 
-import pandas as pd
 from loguru import logger
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import func, select
 
-from config import BASE_NAME, LOGFILE
+from broadcasts import broadcasts_ready, get_broadcast_keyboard
+import config
+from catalog import catalog
+from database import on_commit
 from dialog_classes import (DialogClass, StateProcessorClass,
                             ValidationException)
-from models import AgeCategories, Appointment, Service, User
+from models import (AgeCategories, Appointment, Broadcast, FunnelCounter,
+                    Service)
+from reports import report_jobs
 from user_services import UserServices
 
-logger.add(LOGFILE, format="{time} {level} {message}", level="ERROR", rotation="400KB", compression="zip")
-
-engine = create_engine(BASE_NAME, echo=True)
-Session = sessionmaker(bind=engine)
+REPORT_PENDING_MESSAGE = "Документ формируется, я пришлю его, как только он будет готов."
+APPOINTMENTS_PAGE_SIZE = getattr(config, "APPOINTMENTS_PAGE_SIZE", 5)
+# длинные поля обрезаются, чтобы страница уложилась в лимит сообщения Telegram
+APPOINTMENT_TEXT_LIMIT = 300
+APPOINTMENT_NAME_LIMIT = 100
+APPOINTMENT_CONTACT_LIMIT = 32
+MESSAGE_LIMIT = 4096
+# сколько ждать отправки предпросмотра рассылки, чтобы узнать, принял ли Telegram разметку
+BROADCAST_PREVIEW_TIMEOUT = getattr(config, "BROADCAST_PREVIEW_TIMEOUT", 10)
 
 
 class MyServices(StateProcessorClass):
@@ -26,18 +34,30 @@ class MyServices(StateProcessorClass):
 
     text_message = "Список ваших услуг"
 
+    def catalog_changed(self):
+        return self.session.info.get("catalog_changed", False)
+
+    def get_keyboard_cache_key(self):
+        if self.catalog_changed():
+            return None
+        return ("my_services", catalog.version)
+
     def get_inline_buttons(self):
         try:
-            session = Session()
-            services = session.query(Service).all()
+            if self.catalog_changed():
+                services = self.session.query(Service).order_by(Service.id).all()
+            else:
+                services = catalog.all()
 
             buttons = {}
             for service in services:
                 buttons[service.id] = service.name
-            session.close()
             buttons["new_service"] = "Добавить новую"
+            buttons["appointments"] = "Последние заявки"
             buttons["get_statistics"] = "Выгрузить список заявок"
             buttons["get_user_statistics"] = "Статистика пользователей"
+            buttons["funnel"] = "Воронка"
+            buttons["broadcast"] = "Рассылка"
             return buttons
         except Exception as e:
             logger.error(e)
@@ -104,9 +124,7 @@ class IsLink(StateProcessorClass):
         self.set_context(self.context)
 
 
-def save_service(service_data):
-
-    session = Session()
+def save_service(session, service_data):
     if "service_id" in service_data:
         service = session.query(Service).get(service_data["service_id"])
 
@@ -124,7 +142,8 @@ def save_service(service_data):
             link=service_data["link"],
         )
         session.add(new_user)
-    session.commit()
+    session.flush()
+    catalog.mark_changed(session)
 
 
 class WaitingForIsLink(StateProcessorClass):
@@ -146,10 +165,11 @@ class WaitingForIsLink(StateProcessorClass):
         else:
             try:
                 self.context["link"] = None
-                save_service(self.context)
+                save_service(self.session, self.context)
                 self.text_message = "Услуга сохранена успешно."
             except Exception as e:
                 logger.error(e)
+                self.session.rollback()
                 self.text_message = "Ошибка сохранения услуги."
             finally:
                 self.redirect_class = MyServices
@@ -178,10 +198,11 @@ class WaitingForLink(StateProcessorClass):
         else:
             raise ValidationException
         try:
-            save_service(self.context)
+            save_service(self.session, self.context)
             self.text_message = "Услуга сохранена успешно"
         except Exception as e:
             logger.error(e)
+            self.session.rollback()
             self.text_message = "Ошибка сохранения услуги"
 
 
@@ -193,14 +214,10 @@ class GetStatistics(StateProcessorClass):  # вход по коллбеку
         self.next_state = "@waiting_for_date"
 
     def get_reply_buttons(self):
-        session = Session()
-        min_date = (
-            session.query(Appointment)
-            .order_by(Appointment.date)
-            .first()
-            .date.strftime("%d.%m.%Y")
-        )
-        return [min_date]
+        min_date = self.session.query(func.min(Appointment.date)).scalar()
+        if min_date is None:
+            return [datetime.today().date().strftime("%d.%m.%Y")]
+        return [min_date.strftime("%d.%m.%Y")]
 
 
 class WaitingForDate(StateProcessorClass):
@@ -231,7 +248,7 @@ class SendingStatistics(StateProcessorClass):
         super().__init__(**kwargs)
         self.next_state = "@my_services"
 
-    text_message = "Теперь вы можете скачать документ."
+    text_message = REPORT_PENDING_MESSAGE
 
     redirect_class = MyServices
     redirect_next_state = "@my_services"
@@ -248,40 +265,9 @@ class SendingStatistics(StateProcessorClass):
             return False
 
     def business_logic(self):
-        since_date = datetime.strptime(self.context["since_date"], "%d.%m.%Y")
-        until_date = datetime.strptime(self.users_message, "%d.%m.%Y")
-
-        session = Session()
-        try:
-            appointments = (
-                session.query(Appointment)
-                .filter(Appointment.date > since_date, Appointment.date < until_date)
-                .all()
-            )
-            data = [
-                {
-                    "Алиас": appointment.username,
-                    "Имя": appointment.client_name,
-                    "Услуга": "Удаленная услуга" if appointment.service is None else appointment.service.name,
-                    "Описание проблемы": appointment.problem_description,
-                    "Запрос": appointment.request,
-                    "Номер телефона": appointment.phone_number,
-                    "Дата": appointment.date.strftime("%d.%m.%Y"),
-                }
-                for appointment in appointments
-            ]
-            session.close()
-
-            df = pd.DataFrame(data)
-            excel_buffer = BytesIO()
-            with pd.ExcelWriter(excel_buffer, engine="openpyxl") as writer:
-                df.to_excel(writer, index=False)
-            excel_buffer.seek(0)
-            excel_buffer.name = "Запись на консультации.xlsx"
-            self.document = excel_buffer
-        except Exception as e:
-            logger.error(e)
-            self.invalid_message = "Ошибка создания документа"
+        params = (self.context["since_date"], self.users_message)
+        user_id = self.user.id
+        on_commit(self.session, lambda: report_jobs.submit(user_id, "appointments", params))
 
 
 class SelectService(StateProcessorClass):
@@ -304,9 +290,8 @@ class SelectService(StateProcessorClass):
     }
 
     def business_logic(self):
-        session = Session()
         try:
-            service = session.query(Service).get(self.callback)
+            service = catalog.get(self.callback)
             self.text_message = f"<b>Название услуги:</b> {service.name}\n<b>Описание:</b>\n{service.description}\n<b>Возрастная категория:</b>{service.age_category.value}"
             if service.is_link:
                 self.text_message += f"\n<b>Ссылка:</b>\n{service.link}"
@@ -323,8 +308,6 @@ class SelectService(StateProcessorClass):
             )
         except:
             raise ValidationException
-        finally:
-            session.close()
 
 
 class DeleteService(StateProcessorClass):# вход по колбеку
@@ -333,13 +316,14 @@ class DeleteService(StateProcessorClass):# вход по колбеку
 
     def business_logic(self):
         try:
-            session = Session()
-            service = session.query(Service).get(self.context["service_id"])
-            session.delete(service)
-            session.commit()
+            service = self.session.query(Service).get(self.context["service_id"])
+            self.session.delete(service)
+            self.session.flush()
+            catalog.mark_changed(self.session)
             self.text_message = "Услуга успешно удалена"
         except Exception as e:
             logger.error(e)
+            self.session.rollback()
             self.text_message = "Ошибка удаления услуги"
 
 
@@ -436,53 +420,287 @@ class NewWaitingForLink(WaitingForLink):
         if self.callback != "save_previous":
             self.context["link"] = self.users_message
         try:
-            save_service(self.context)
+            save_service(self.session, self.context)
             self.text_message = "Услуга сохранена успешно"
         except Exception as e:
             logger.error(e)
+            self.session.rollback()
             self.text_message = "Ошибка сохранения услуги"
 
 
 class GetUserStatistics(StateProcessorClass):
     redirect_class = MyServices
     redirect_next_state = "@my_services"
-    text_message = "Теперь вы можете скачать документ."
+    text_message = REPORT_PENDING_MESSAGE
+
+    def business_logic(self):
+        user_id = self.user.id
+        on_commit(self.session, lambda: report_jobs.submit(user_id, "user_statistics"))
+
+
+class Funnel(StateProcessorClass):  # вход по коллбеку
+    redirect_class = MyServices
+    redirect_next_state = "@my_services"
+
+    def business_logic(self):
+        counters = FunnelCounter.get_counts(self.session)
+        lines = ["<b>Пользователи по экранам</b>"]
+        for state, state_processor in UserServices.states.items():
+            lines.append(f"{state_processor.SCREEN_NAME}: {counters.get(('user_services', state), 0)}")
+        admin_users = sum(
+            users for (dialog, _), users in counters.items() if dialog == "admin_services"
+        )
+        lines.append(f"Админ меню: {admin_users}")
+        self.text_message = "\n".join(lines)
+
+
+def shorten(text, limit=APPOINTMENT_TEXT_LIMIT):
+    if len(text) > limit:
+        text = text[:limit] + "…"
+    return escape(text)
+
+
+def format_appointment(appointment):
+    service_name = "Удаленная услуга" if appointment.service_name is None else appointment.service_name
+    return (
+        f"<b>{appointment.date.strftime('%d.%m.%Y')}</b> {shorten(service_name, APPOINTMENT_NAME_LIMIT)}\n"
+        f"<b>Имя клиента:</b> {shorten(appointment.client_name, APPOINTMENT_NAME_LIMIT)}\n"
+        f"<b>Алиас:</b> @{shorten(appointment.username or '', APPOINTMENT_CONTACT_LIMIT)}\n"
+        f"<b>Номер телефона:</b> {shorten(appointment.phone_number, APPOINTMENT_CONTACT_LIMIT)}\n"
+        f"<b>Описание проблемы:</b> {shorten(appointment.problem_description)}\n"
+        f"<b>Запрос:</b> {shorten(appointment.request)}"
+    )
+
+
+def message_length(text):
+    # Telegram считает длину в UTF-16; разметка и сущности здесь тоже
+    # учитываются, поэтому оценка с запасом
+    return len(text.encode("utf-16-le")) // 2
+
+
+def fit_page(header, items):
+    # сколько заявок уместится в одно сообщение, но не меньше одной
+    length = message_length(header)
+    for count, item in enumerate(items):
+        length += message_length(item) + 2
+        if count and length > MESSAGE_LIMIT:
+            return count
+    return len(items)
+
+
+class Appointments(StateProcessorClass):  # вход по коллбеку
+    # Постраничный просмотр заявок, новые сверху. В контексте хранятся
+    # ключи (date, id) первой и последней заявки страницы, от них
+    # Appointment.get_page читает соседнюю страницу.
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.next_state = "@appointments_page"
+
+    def get_page(self):
+        return Appointment.get_page(self.session, APPOINTMENTS_PAGE_SIZE), 1
 
     def business_logic(self):
-        session = Session()
+        (appointments, has_more), page = self.get_page()
+        newer = self.callback == "appointments_prev"
+        if not appointments and page != 1:
+            # кнопка со старой страницы, а заявки с тех пор удалили
+            (appointments, has_more), page = Appointments.get_page(self)
+            newer = False
+        if not appointments:
+            self.text_message = "Заявок пока нет"
+            self.inline_buttons = {"back": "Назад"}
+            self.set_context({})
+            return
+        if newer:
+            has_prev, has_next = has_more, True
+        else:
+            has_prev, has_next = page > 1, has_more
+
+        formatted = [format_appointment(appointment) for appointment in appointments]
+        header = f"<b>Заявки, страница {page}</b>"
+        # не влезающие в сообщение заявки переходят на соседнюю страницу;
+        # при листании к новым оставляем ближайшие к текущей странице
+        count = fit_page(header, formatted[::-1] if newer else formatted)
+        if count < len(appointments):
+            if newer:
+                appointments, formatted = appointments[-count:], formatted[-count:]
+                has_prev = True
+            else:
+                appointments, formatted = appointments[:count], formatted[:count]
+                has_next = True
+        if newer and not has_prev:
+            # пока листали, могли появиться новые заявки
+            page = 1
+
+        self.text_message = "\n\n".join([f"<b>Заявки, страница {page}</b>"] + formatted)
+        self.inline_buttons = {}
+        if has_prev:
+            self.inline_buttons["appointments_prev"] = "Новее"
+        if has_next:
+            self.inline_buttons["appointments_next"] = "Старее"
+        self.inline_buttons["back"] = "Назад"
+        first, last = appointments[0], appointments[-1]
+        self.set_context(
+            {
+                "page": page,
+                "first": [first.date.isoformat(), first.id],
+                "last": [last.date.isoformat(), last.id],
+            }
+        )
+
+
+def get_page_key(key):
+    return date.fromisoformat(key[0]), key[1]
+
+
+class PageAppointments(Appointments):
+    invalid_message = "Ошибка. Откройте список заявок заново."
+
+    def is_valid(self):
+        return "page" in self.context
+
+
+class NextAppointments(PageAppointments):
+    def get_page(self):
+        page = Appointment.get_page(
+            self.session, APPOINTMENTS_PAGE_SIZE, after=get_page_key(self.context["last"])
+        )
+        return page, self.context["page"] + 1
+
+
+class PrevAppointments(PageAppointments):
+    def get_page(self):
+        page = Appointment.get_page(
+            self.session, APPOINTMENTS_PAGE_SIZE, before=get_page_key(self.context["first"])
+        )
+        return page, self.context["page"] - 1
+
+
+class BroadcastText(StateProcessorClass):  # вход по коллбеку
+    text_message = "Введите текст рассылки. Можно использовать HTML-разметку."
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.next_state = "@broadcast_buttons"
+
+
+class BroadcastButtons(StateProcessorClass):
+    text_message = (
+        "Добавьте кнопки-ссылки: каждая на отдельной строке в формате "
+        "<b>Текст - https://example.com</b>"
+    )
+    inline_buttons = {"no_buttons": "Без кнопок"}
+
+    invalid_message = "Ошибка. Введите текст рассылки."
+
+    def is_valid(self):
+        if self.users_message is None:
+            return False
+        return True
+
+    def business_logic(self):
+        self.set_context({"broadcast_text": self.users_message})
+
+
+def parse_link_buttons(message):
+    buttons = []
+    for line in message.splitlines():
+        if not line.strip():
+            continue
+        match = re.fullmatch(r"\s*(.+?)\s+-\s+(https?://\S+)\s*", line)
+        if match is None:
+            return None
+        buttons.append([match.group(1), match.group(2)])
+    return buttons or None
+
+
+class BroadcastFilter(StateProcessorClass):
+    text_message = "Кому отправить рассылку? Можно выбрать пользователей, остановившихся на определённом экране."
+
+    invalid_message = "Ошибка. Пришлите кнопки в формате <b>Текст - https://example.com</b> или нажмите «Без кнопок»."
+
+    def get_inline_buttons(self):
+        buttons = {"all": "Всем пользователям"}
+        for state, state_processor in UserServices.states.items():
+            buttons[state] = state_processor.SCREEN_NAME
+        return buttons
+
+    def is_valid(self):
+        if self.callback == "no_buttons":
+            return True
+        if self.users_message is None:
+            return False
+        return parse_link_buttons(self.users_message) is not None
+
+    def business_logic(self):
+        if self.callback == "no_buttons":
+            self.context["broadcast_buttons"] = []
+        else:
+            self.context["broadcast_buttons"] = parse_link_buttons(self.users_message)
+        self.set_context(self.context)
+
+
+class BroadcastConfirm(StateProcessorClass):
+    inline_buttons = {
+        "send": "Отправить",
+        "cancel": "Отмена",
+    }
+
+    invalid_message = "Ошибка. Выберите получателей из меню."
+
+    def is_valid(self):
+        return self.callback == "all" or self.callback in UserServices.states
+
+    def business_logic(self):
+        screen = None if self.callback == "all" else self.callback
+        self.context["broadcast_screen"] = screen
+        self.set_context(self.context)
+        recipients = self.session.execute(
+            select(func.count()).select_from(Broadcast.recipients(screen).subquery())
+        ).scalar()
+        # предпросмотр: администратор видит рассылку так же, как получатели
+        future = self.send_message(
+            message_text=self.context["broadcast_text"],
+            keyboard=get_broadcast_keyboard(self.context["broadcast_buttons"]),
+        )
         try:
-            users = (
-                session.query(User)
-                .all()
-            )
-            data = []
-            for user in users:
-                if user.previous_state is None:
-                    continue
-                state = user.previous_state.split("__")
-                if len(state) < 2:
-                    continue
-                if state[0] == "admin_services":
-                    step = "Админ меню"
-                else:
-                    step = UserServices.states[state[1]].SCREEN_NAME
-                data.append({
-                        "Алиас": user.username,
-                        "ID": user.user_id,
-                        "Текущий шаг": step,
-                    })
-            session.close()
-
-            df = pd.DataFrame(data)
-            excel_buffer = BytesIO()
-            with pd.ExcelWriter(excel_buffer, engine="openpyxl") as writer:
-                df.to_excel(writer, index=False)
-            excel_buffer.seek(0)
-            excel_buffer.name = "Статистика пользователей.xlsx"
-            self.document = excel_buffer
+            if future is not None:
+                future.result(timeout=BROADCAST_PREVIEW_TIMEOUT)
         except Exception as e:
-            logger.error(e)
-            self.invalid_message = "Ошибка создания документа"
+            # 400: Telegram не разобрал разметку, такую рассылку не получит никто
+            if getattr(e, "error_code", None) == 400:
+                description = getattr(e, "description", None) or str(e)
+                self.text_message = f"Telegram не принял текст рассылки: {escape(description)}"
+                self.inline_buttons = {}
+                self.next_state = "@broadcast_buttons"
+                self.redirect_class = BroadcastText
+                self.redirect_next_state = "@broadcast_buttons"
+                return
+            logger.warning(f"Предпросмотр рассылки не проверен: {e}")
+        self.text_message = f"Получателей: {recipients}. Отправить рассылку?"
+
+
+class StartBroadcast(StateProcessorClass):  # вход по коллбеку
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.next_state = "@my_services"
+
+    redirect_class = MyServices
+    redirect_next_state = "@my_services"
+    text_message = "Рассылка запущена. Я пришлю отчёт, когда она завершится."
+
+    def business_logic(self):
+        self.session.add(
+            Broadcast(
+                admin_id=self.user.id,
+                text=self.context["broadcast_text"],
+                buttons=self.context["broadcast_buttons"],
+                screen=self.context["broadcast_screen"],
+                created_at=datetime.now(),
+            )
+        )
+        self.session.flush()
+        on_commit(self.session, broadcasts_ready.set)
 
 
 class AdminServices(DialogClass):
@@ -490,8 +708,11 @@ class AdminServices(DialogClass):
         "my_services": MyServices,
         "my_services_waiting_callback": {
             "new_service": SetNameService,
+            "appointments": Appointments,
             "get_statistics": GetStatistics,
             "get_user_statistics": GetUserStatistics,
+            "funnel": Funnel,
+            "broadcast": BroadcastText,
             "": SelectService,
         },
         "set_description": SetDescription,
@@ -512,4 +733,18 @@ class AdminServices(DialogClass):
         "new_waiting_for_link": NewWaitingForLink,
         "waiting_for_date": WaitingForDate,
         "sending_statistics": SendingStatistics,
+        "broadcast_buttons": BroadcastButtons,
+        "broadcast_filter": BroadcastFilter,
+        "broadcast_confirm": BroadcastConfirm,
+        "broadcast_start": {
+            "send": StartBroadcast,
+            "cancel": MyServices,
+            "": MyServices,
+        },
+        "appointments_page": {
+            "appointments_next": NextAppointments,
+            "appointments_prev": PrevAppointments,
+            "back": MyServices,
+            "": MyServices,
+        },
     }
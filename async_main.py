@@ -0,0 +1,111 @@
+import asyncio
+import weakref
+
+from loguru import logger
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import BotCommand
+
+from config import ADMINS, BOT_TOKEN
+from database import dispose_async_engine
+from dispatcher import AsyncOutboundDispatcher
+from metrics import metrics
+from models import User
+from router import process_update
+from services import BackgroundServices
+
+bot = AsyncTeleBot(BOT_TOKEN)
+
+# обновления одного пользователя обрабатываются строго по очереди
+user_locks = weakref.WeakValueDictionary()
+
+
+# создаётся в run(): отправителям нужен запущенный цикл событий
+outbound = None
+
+
+def get_user_lock(user_id):
+    lock = user_locks.get(user_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        user_locks[user_id] = lock
+    return lock
+
+
+async def routing(user, users_message=None, callback=None, command=None, reset_state=None, start=False):
+    async with get_user_lock(user.id):
+        if reset_state is None and not start:
+            # состояние читается через aiosqlite и попадает в кэш
+            await User.get_state_async(user.id)
+        # вся единица работы выполняется в одном потоке: сессия SQLAlchemy
+        # не переходит между потоками, а фиксация не ждёт свободного потока
+        await asyncio.to_thread(
+            process_update, outbound, user, users_message, callback, reset_state, start
+        )
+
+
+async def update_commands(user_id):
+    commands = [
+        BotCommand(command="/menu", description="Меню"),
+    ]
+    if user_id in ADMINS:
+        commands.append(BotCommand(command="/admin_menu", description="Меню администратора"))
+        commands.append(BotCommand(command="/metrics", description="Метрики бота"))
+    await bot.set_my_commands(commands)
+
+
+@bot.message_handler(commands=["start"])
+async def send_welcome(message):
+    # блокировка пользователя берётся сразу, поэтому сообщения после /start
+    # из той же пачки обновлений обрабатываются уже после сброса
+    await routing(message.from_user, command="menu", start=True)
+    await update_commands(message.from_user.id)
+
+
+@bot.message_handler(commands=["menu"])
+async def send_welcome(message):
+    await routing(message.from_user, command="menu", reset_state=("user_services", "menu"))
+
+
+@bot.message_handler(commands=["admin_menu"])
+async def send_welcome(message):
+    if message.from_user.id in ADMINS:
+        await routing(
+            message.from_user,
+            command="menu",
+            reset_state=("admin_services", "my_services"),
+        )
+
+
+@bot.message_handler(commands=["metrics"])
+async def send_metrics(message):
+    if message.from_user.id in ADMINS:
+        outbound.send_message(message.from_user.id, metrics.summary())
+
+
+@bot.message_handler(func=lambda message: True)
+async def message_router(message):
+    await routing(message.from_user, users_message=message.text)
+
+
+@bot.callback_query_handler(func=lambda call: True)
+async def callback_handler(call):
+    await routing(call.from_user, callback=call.data)
+
+
+async def run():
+    global outbound
+    outbound = AsyncOutboundDispatcher(bot, asyncio.get_running_loop())
+    services = BackgroundServices(outbound)
+    await asyncio.to_thread(services.start)
+    outbound.start()
+    try:
+        await bot.infinity_polling()
+    finally:
+        await asyncio.to_thread(services.stop)
+        await outbound.stop_async()
+        await dispose_async_engine()
+        await logger.complete()
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
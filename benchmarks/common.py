@@ -0,0 +1,23 @@
+import os
+import sys
+import tempfile
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_config(**overrides):
+    # бенчмарки не трогают config.py бота: база и лог во временной папке
+    workdir = tempfile.mkdtemp(prefix="consultations-bench-")
+    config = types.ModuleType("config")
+    config.BOT_TOKEN = "123456:bench"
+    config.BASE_NAME = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    config.ADMINS = [1]
+    config.LOGFILE = os.path.join(workdir, "bot.log")
+    config.SQL_ECHO = False
+    for name, value in overrides.items():
+        setattr(config, name, value)
+    sys.modules["config"] = config
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    return workdir
@@ -0,0 +1,140 @@
+import argparse
+import time
+
+from common import setup_config
+
+parser = argparse.ArgumentParser(description="Пропускная способность и задержка обработки диалогов")
+parser.add_argument("--users", type=int, default=200, help="клиентов, проходящих запись")
+parser.add_argument("--admin-edits", type=int, default=50, help="редактирований услуги администратором")
+parser.add_argument("--write-behind", action="store_true", help="режим STATE_CACHE_WRITE_BEHIND")
+# пороги подобраны с запасом для SQLite на обычном диске
+parser.add_argument("--min-updates-per-second", type=float, default=150)
+parser.add_argument("--max-p50-ms", type=float, default=10)
+parser.add_argument("--max-p99-ms", type=float, default=50)
+parser.add_argument("--max-queries-per-update", type=float, default=6)
+args = parser.parse_args()
+
+setup_config(STATE_CACHE_WRITE_BEHIND=args.write_behind)
+
+from database import QueryCounter, Session  # noqa: E402
+from router import process_update  # noqa: E402
+from migrations import migrate  # noqa: E402
+from models import AgeCategories, Service, User  # noqa: E402
+from state_cache import state_cache  # noqa: E402
+
+ADMIN_ID = 1
+
+
+class StubBot:
+    def __init__(self):
+        self.messages = 0
+        self.documents = 0
+
+    def send_message(self, chat_id, *args, **kwargs):
+        self.messages += 1
+
+    def send_document(self, chat_id, *args, **kwargs):
+        self.documents += 1
+
+
+class TelegramUser:
+    def __init__(self, user_id, username):
+        self.id = user_id
+        self.username = username
+
+
+def booking_flow(service_id):
+    return [
+        {"reset_state": ("user_services", "menu")},
+        {"callback": "get_consultation"},
+        {"callback": AgeCategories.ZERO_SIX.name},
+        {"callback": str(service_id)},
+        {"callback": f"appoint__{service_id}"},
+        {"users_message": "Иван"},
+        {"users_message": "Не спит ночью"},
+        {"users_message": "Наладить сон"},
+        {"users_message": "+79990000000"},
+        {"callback": "agree"},
+    ]
+
+
+def admin_edit_flow(service_id, index):
+    return [
+        {"reset_state": ("admin_services", "my_services")},
+        {"callback": str(service_id)},
+        {"callback": "edit_service"},
+        {"callback": "save_previous"},
+        {"users_message": f"Описание {index}"},
+        {"callback": "save_previous"},
+        {"callback": "False"},
+    ]
+
+
+def prepare(users):
+    migrate()
+    with Session() as session:
+        service = Service(
+            age_category=AgeCategories.ZERO_SIX,
+            name="Консультация",
+            description="Описание",
+            is_link=False,
+        )
+        session.add(service)
+        session.commit()
+        service_id = service.id
+    User.create_user(ADMIN_ID, "admin")
+    for index in range(users):
+        User.create_user(ADMIN_ID + 1 + index, f"user{index}")
+    return service_id
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def main():
+    service_id = prepare(args.users)
+    bot = StubBot()
+    work = []
+    for index in range(args.users):
+        user = TelegramUser(ADMIN_ID + 1 + index, f"user{index}")
+        work.extend((user, update) for update in booking_flow(service_id))
+    admin = TelegramUser(ADMIN_ID, "admin")
+    for index in range(args.admin_edits):
+        work.extend((admin, update) for update in admin_edit_flow(service_id, index))
+
+    latencies = []
+    with QueryCounter() as counter:
+        started_at = time.perf_counter()
+        for user, update in work:
+            update_started_at = time.perf_counter()
+            process_update(bot, user, **update)
+            latencies.append(time.perf_counter() - update_started_at)
+        elapsed = time.perf_counter() - started_at
+
+    latencies.sort()
+    updates_per_second = len(work) / elapsed
+    p50 = percentile(latencies, 0.5) * 1000
+    p99 = percentile(latencies, 0.99) * 1000
+    queries_per_update = counter.count / len(work)
+    print(f"обновлений: {len(work)}, сообщений боту: {bot.messages}")
+    print(f"обновлений в секунду: {updates_per_second:.0f}")
+    print(f"задержка p50: {p50:.2f} мс, p99: {p99:.2f} мс")
+    print(f"запросов к базе на обновление: {queries_per_update:.2f}")
+    print(f"кэш состояний: {state_cache.stats()}")
+
+    failures = []
+    if updates_per_second < args.min_updates_per_second:
+        failures.append(f"обновлений в секунду {updates_per_second:.0f} < {args.min_updates_per_second}")
+    if p50 > args.max_p50_ms:
+        failures.append(f"p50 {p50:.2f} мс > {args.max_p50_ms}")
+    if p99 > args.max_p99_ms:
+        failures.append(f"p99 {p99:.2f} мс > {args.max_p99_ms}")
+    if queries_per_update > args.max_queries_per_update:
+        failures.append(f"запросов на обновление {queries_per_update:.2f} > {args.max_queries_per_update}")
+    if failures:
+        raise SystemExit("Регрессия: " + "; ".join(failures))
+
+
+if __name__ == "__main__":
+    main()
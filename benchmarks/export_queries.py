@@ -0,0 +1,74 @@
+import argparse
+import time
+from datetime import date, timedelta
+
+from common import setup_config
+
+setup_config()
+
+from database import QueryCounter, Session  # noqa: E402
+from exporters import export_appointments  # noqa: E402
+from migrations import migrate  # noqa: E402
+from models import AgeCategories, Appointment, Service  # noqa: E402
+
+
+def fill(rows, services):
+    with Session() as session:
+        service_ids = []
+        for index in range(services):
+            service = Service(
+                age_category=list(AgeCategories)[index % len(AgeCategories)],
+                name=f"Услуга {index}",
+                description="Описание",
+                is_link=False,
+            )
+            session.add(service)
+            session.flush()
+            service_ids.append(service.id)
+        today = date.today()
+        session.add_all(
+            [
+                Appointment(
+                    # часть заявок без услуги, как после удаления услуги
+                    service_id=None if index % 10 == 0 else service_ids[index % services],
+                    client_name=f"Клиент {index}",
+                    problem_description="Проблема",
+                    request="Запрос",
+                    phone_number="+79990000000",
+                    username=f"user{index}",
+                    date=today - timedelta(days=index % 365),
+                )
+                for index in range(rows)
+            ]
+        )
+        session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Число запросов и время выгрузки заявок")
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--services", type=int, default=20)
+    parser.add_argument("--max-queries", type=int, default=1)
+    args = parser.parse_args()
+
+    migrate()
+    fill(args.rows, args.services)
+    since_date = date.today() - timedelta(days=400)
+    until_date = date.today() + timedelta(days=1)
+
+    with Session() as session, QueryCounter() as counter:
+        started = time.perf_counter()
+        document, name = export_appointments(session, since_date, until_date)
+        elapsed = time.perf_counter() - started
+    size = document.seek(0, 2)
+    document.close()
+
+    print(f"{name}: {args.rows} строк, {counter.count} запросов, {elapsed:.2f} с, {size} байт")
+    if counter.count > args.max_queries:
+        for statement in counter.statements[:5]:
+            print(statement)
+        raise SystemExit(f"Ожидалось не больше {args.max_queries} запросов, выполнено {counter.count}")
+
+
+if __name__ == "__main__":
+    main()
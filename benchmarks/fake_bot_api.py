@@ -0,0 +1,160 @@
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+# Локальная замена api.telegram.org для нагрузочных тестов: отдаёт обновления
+# через getUpdates, запоминает исходящие вызовы и умеет добавлять задержку
+# и ответы 429. Бот направляется на сервер через telebot.apihelper.API_URL.
+
+
+class FakeBotApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, error_rate=0.0, retry_after=1):
+        super().__init__((host, port), FakeBotApiHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.first_call_at = {}
+        self.polled = threading.Event()
+        self.throttled = Counter()
+        self.listeners = []
+        self._updates = []
+        self._update_id = 0
+        self._message_id = 0
+        self._condition = threading.Condition()
+        self.thread = None
+
+    @property
+    def api_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/bot{{0}}/{{1}}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="fake-bot-api", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def next_message_id(self):
+        with self._condition:
+            self._message_id += 1
+            return self._message_id
+
+    def push_update(self, update):
+        with self._condition:
+            self._update_id += 1
+            update["update_id"] = self._update_id
+            self._updates.append(update)
+            self._condition.notify_all()
+
+    def push_message(self, user_id, text):
+        self.push_update({"message": self.make_message(user_id, text, from_user=True)})
+
+    def push_callback(self, user_id, data):
+        self.push_update(
+            {
+                "callback_query": {
+                    "id": str(self.next_message_id()),
+                    "from": make_user(user_id),
+                    "message": self.make_message(user_id, "", from_user=False),
+                    "chat_instance": str(user_id),
+                    "data": data,
+                }
+            }
+        )
+
+    def make_message(self, chat_id, text, from_user):
+        message = {
+            "message_id": self.next_message_id(),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "text": text,
+        }
+        message["from"] = make_user(chat_id) if from_user else make_user(0, is_bot=True)
+        return message
+
+    def get_updates(self, offset, timeout):
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            # подтверждённые ботом обновления больше не нужны
+            self._updates = [update for update in self._updates if update["update_id"] >= offset]
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return list(self._updates[:100])
+
+    def call(self, method, params):
+        self.calls[method] += 1
+        self.first_call_at.setdefault(method, time.monotonic())
+        if method == "getUpdates":
+            self.polled.set()
+            offset = int(params.get("offset", 0))
+            timeout = min(float(params.get("timeout", 0)), 5)
+            return 200, {"ok": True, "result": self.get_updates(offset, timeout)}
+        if self.latency:
+            time.sleep(self.latency)
+        if method in ("sendMessage", "sendDocument") and random.random() < self.error_rate:
+            self.throttled[method] += 1
+            return 429, {
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }
+        if method in ("sendMessage", "sendDocument"):
+            chat_id = int(params["chat_id"])
+            message = self.make_message(chat_id, params.get("text", ""), from_user=False)
+            if method == "sendDocument":
+                message["document"] = {"file_id": str(message["message_id"]), "file_unique_id": "x"}
+            for listener in self.listeners:
+                listener(method, chat_id, params)
+            return 200, {"ok": True, "result": message}
+        if method == "getMe":
+            return 200, {"ok": True, "result": make_user(0, is_bot=True)}
+        return 200, {"ok": True, "result": True}
+
+
+def make_user(user_id, is_bot=False):
+    return {
+        "id": int(user_id),
+        "is_bot": is_bot,
+        "first_name": "Бот" if is_bot else f"Пользователь {user_id}",
+        "username": "bot" if is_bot else f"user{user_id}",
+    }
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.handle_call()
+
+    def do_POST(self):
+        self.handle_call()
+
+    def handle_call(self):
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+        if self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+            params.update(parse_qsl(body.decode("utf-8")))
+        method = url.path.rsplit("/", 1)[-1]
+        status, result = self.server.call(method, params)
+        payload = json.dumps(result, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
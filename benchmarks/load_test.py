@@ -0,0 +1,208 @@
+import argparse
+import heapq
+import random
+import threading
+import time
+
+from common import setup_config
+from fake_bot_api import FakeBotApiServer
+
+FIRST_USER_ID = 1000
+
+
+def booking_steps(service_id):
+    return [
+        ("message", "/start"),
+        ("callback", "get_consultation"),
+        ("callback", "ZERO_SIX"),
+        ("callback", str(service_id)),
+        ("callback", f"appoint__{service_id}"),
+        ("message", "Иван"),
+        ("message", "Не спит ночью"),
+        ("message", "Наладить сон"),
+        ("message", "+79990000000"),
+        ("callback", "agree"),
+    ]
+
+
+class SimulatedUser:
+    def __init__(self, user_id, steps):
+        self.user_id = user_id
+        self.steps = steps
+        self.step = 0
+        self.sent_at = None
+
+
+class LoadGenerator:
+    # Пользователь отправляет следующий шаг записи только после ответа бота
+    # на предыдущий и паузы "на размышление"
+    def __init__(self, server, users, steps, think_time, reply_timeout, ramp_up):
+        self.server = server
+        self.think_time = think_time
+        self.reply_timeout = reply_timeout
+        self.users = {
+            FIRST_USER_ID + index: SimulatedUser(FIRST_USER_ID + index, steps)
+            for index in range(users)
+        }
+        self._condition = threading.Condition()
+        self._schedule = []
+        self.latencies = []
+        self.sent = 0
+        self.timeouts = 0
+        self.finished = 0
+        self.failed = 0
+        now = time.monotonic()
+        for index, user_id in enumerate(self.users):
+            heapq.heappush(self._schedule, (now + ramp_up * index / max(users, 1), user_id))
+        server.listeners.append(self.on_reply)
+
+    def on_reply(self, method, chat_id, params):
+        now = time.monotonic()
+        with self._condition:
+            user = self.users.get(chat_id)
+            if user is None or user.sent_at is None:
+                return
+            self.latencies.append(now - user.sent_at)
+            user.sent_at = None
+            user.step += 1
+            if user.step < len(user.steps):
+                pause = self.think_time * random.uniform(0.5, 1.5)
+                heapq.heappush(self._schedule, (now + pause, chat_id))
+            else:
+                self.finished += 1
+            self._condition.notify()
+
+    def send(self, user):
+        kind, value = user.steps[user.step]
+        if kind == "message":
+            self.server.push_message(user.user_id, value)
+        else:
+            self.server.push_callback(user.user_id, value)
+
+    def check_timeouts(self, now):
+        for user in self.users.values():
+            if user.sent_at is not None and now - user.sent_at > self.reply_timeout:
+                user.sent_at = None
+                self.timeouts += 1
+                self.failed += 1
+
+    def run(self):
+        while True:
+            due = []
+            with self._condition:
+                now = time.monotonic()
+                self.check_timeouts(now)
+                if self.finished + self.failed >= len(self.users):
+                    return
+                while self._schedule and self._schedule[0][0] <= now:
+                    _, user_id = heapq.heappop(self._schedule)
+                    user = self.users[user_id]
+                    user.sent_at = now
+                    due.append(user)
+                if not due:
+                    timeout = 1.0
+                    if self._schedule:
+                        timeout = min(timeout, self._schedule[0][0] - now)
+                    self._condition.wait(timeout)
+            for user in due:
+                self.send(user)
+                self.sent += 1
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест main.py через локальный Bot API")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--think-time", type=float, default=1.0, help="средняя пауза между шагами, с")
+    parser.add_argument("--ramp-up", type=float, default=10.0, help="время подключения всех пользователей, с")
+    parser.add_argument("--reply-timeout", type=float, default=60.0)
+    parser.add_argument("--api-latency", type=float, default=0.05, help="задержка ответа Bot API, с")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 429 на отправку")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--senders", type=int, default=4, help="потоков OutboundDispatcher")
+    parser.add_argument("--global-rate", type=float, default=25, help="лимит отправки бота, сообщений в секунду")
+    parser.add_argument("--chat-rate", type=float, default=1)
+    args = parser.parse_args()
+
+    setup_config(
+        WORKERS=args.workers,
+        DISPATCHER_SENDERS=args.senders,
+        DISPATCHER_GLOBAL_RATE=args.global_rate,
+        DISPATCHER_GLOBAL_BURST=max(args.global_rate, 1),
+        DISPATCHER_CHAT_RATE=args.chat_rate,
+        METRICS_ENABLED=False,
+        REPORT_WORKERS=0,
+    )
+
+    from telebot import apihelper
+
+    import main as bot_main
+    from database import Session
+    from models import AgeCategories, Service
+
+    server = FakeBotApiServer(
+        latency=args.api_latency, error_rate=args.error_rate, retry_after=args.retry_after
+    )
+    server.start()
+    apihelper.API_URL = server.api_url
+
+    bot_main.start_services()
+    with Session() as session:
+        service = Service(
+            age_category=AgeCategories.ZERO_SIX,
+            name="Консультация",
+            description="Описание",
+            is_link=False,
+        )
+        session.add(service)
+        session.commit()
+        service_id = service.id
+
+    polling = threading.Thread(
+        target=bot_main.bot.infinity_polling,
+        kwargs={"timeout": 10, "long_polling_timeout": 5},
+        name="polling",
+        daemon=True,
+    )
+    polling.start()
+
+    generator = LoadGenerator(
+        server,
+        args.users,
+        booking_steps(service_id),
+        args.think_time,
+        args.reply_timeout,
+        args.ramp_up,
+    )
+    started_at = time.monotonic()
+    try:
+        generator.run()
+    finally:
+        elapsed = time.monotonic() - started_at
+        bot_main.bot.stop_polling()
+        bot_main.stop_services()
+        server.stop()
+
+    latencies = sorted(generator.latencies)
+    print(f"пользователей: {args.users}, завершили запись: {generator.finished}, не завершили: {generator.failed}")
+    print(f"шагов: {generator.sent}, ответов: {len(latencies)}, за {elapsed:.1f} с ({len(latencies) / elapsed:.1f} ответов/с)")
+    print(
+        "задержка ответа: "
+        f"p50 {percentile(latencies, 0.5) * 1000:.0f} мс, "
+        f"p95 {percentile(latencies, 0.95) * 1000:.0f} мс, "
+        f"p99 {percentile(latencies, 0.99) * 1000:.0f} мс, "
+        f"max {(latencies[-1] if latencies else 0) * 1000:.0f} мс"
+    )
+    print(f"доля ошибок: {generator.timeouts / max(generator.sent, 1):.2%} (ответ не пришёл за {args.reply_timeout} с)")
+    print(f"вызовы Bot API: {dict(server.calls)}, ответы 429: {dict(server.throttled)}")
+    print(f"отправка: {bot_main.outbound.stats()}")
+    if bot_main.worker_pool is not None:
+        print(f"обработчики: {bot_main.worker_pool.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from fake_bot_api import FakeBotApiServer
+
+HEAVY_MODULES = ["openpyxl", "numpy", "pandas", "aiosqlite", "exporters"]
+
+
+def run_bot(api_url):
+    # дочерний процесс: обычный запуск main.py, но с локальным Bot API
+    from common import setup_config
+
+    setup_config(METRICS_ENABLED=False)
+
+    from telebot import apihelper
+
+    apihelper.API_URL = api_url
+
+    import main
+
+    main.start_services()
+    loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+    print("loaded:" + ",".join(loaded), flush=True)
+    main.bot.infinity_polling(timeout=10, long_polling_timeout=5)
+
+
+def read_rss(pid):
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0
+
+
+def measure(timeout):
+    server = FakeBotApiServer()
+    server.start()
+    started_at = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--child", server.api_url],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    try:
+        if not server.polled.wait(timeout):
+            raise SystemExit(f"Бот не начал опрос за {timeout} с")
+        time_to_first_poll = server.first_call_at["getUpdates"] - started_at
+        # даём процессу закончить инициализацию после первого запроса
+        time.sleep(0.5)
+        rss = read_rss(process.pid)
+    finally:
+        process.terminate()
+        output, _ = process.communicate(timeout=10)
+        server.stop()
+    loaded = ""
+    for line in output.splitlines():
+        if line.startswith("loaded:"):
+            loaded = line[len("loaded:"):]
+    return time_to_first_poll, rss, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Время запуска main.py до первого getUpdates и память")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--max-startup-ms", type=float, default=None)
+    parser.add_argument("--max-rss-mb", type=float, default=None)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_bot(args.child)
+        return
+
+    results = [measure(args.timeout) for _ in range(args.runs)]
+    startup = sorted(result[0] * 1000 for result in results)
+    rss = sorted(result[1] for result in results)
+    median_startup = startup[len(startup) // 2]
+    median_rss = rss[len(rss) // 2]
+    print(f"до первого getUpdates: медиана {median_startup:.0f} мс, min {startup[0]:.0f}, max {startup[-1]:.0f}")
+    print(f"RSS: медиана {median_rss:.1f} МБ")
+    print(f"тяжёлые модули при старте: {results[-1][2] or 'нет'}")
+
+    failures = []
+    if args.max_startup_ms is not None and median_startup > args.max_startup_ms:
+        failures.append(f"запуск {median_startup:.0f} мс > {args.max_startup_ms}")
+    if args.max_rss_mb is not None and median_rss > args.max_rss_mb:
+        failures.append(f"RSS {median_rss:.1f} МБ > {args.max_rss_mb}")
+    if failures:
+        raise SystemExit("Регрессия: " + "; ".join(failures))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+import threading
+import time
+from datetime import datetime
+
+from loguru import logger
+from sqlalchemy import select, update
+
+import config
+from database import Session, session_scope
+from dialog_classes import build_keyboard
+from dispatcher import BULK, NOTIFICATION, is_retryable
+from models import Broadcast, User
+
+BROADCAST_BATCH_SIZE = getattr(config, "BROADCAST_BATCH_SIZE", 100)
+# рассылка оставляет часть общего лимита Telegram интерактивным ответам
+BROADCAST_RATE = getattr(config, "BROADCAST_RATE", 15)
+BROADCAST_POLL_INTERVAL = getattr(config, "BROADCAST_POLL_INTERVAL", 30)
+BROADCAST_SEND_TIMEOUT = getattr(config, "BROADCAST_SEND_TIMEOUT", 300)
+BROADCAST_MAX_ATTEMPTS = getattr(config, "BROADCAST_MAX_ATTEMPTS", 5)
+
+# выставляется после фиксации транзакции с новой рассылкой
+broadcasts_ready = threading.Event()
+
+
+def get_retry_after(error):
+    result_json = getattr(error, "result_json", None) or {}
+    return (result_json.get("parameters") or {}).get("retry_after", 1)
+
+
+def get_broadcast_keyboard(buttons):
+    return build_keyboard(
+        [],
+        {f"link_{index}": {"text": text, "url": url} for index, (text, url) in enumerate(buttons or [])},
+    ).to_json()
+
+
+class BroadcastSender:
+    # Рассылка идёт пачками по User.id (keyset), после каждой пачки позиция
+    # и счётчики сохраняются в broadcast, поэтому после перезапуска она
+    # продолжается с места остановки. Пачка, прерванная перезапуском,
+    # может уйти повторно.
+    def __init__(
+        self,
+        bot,
+        batch_size=BROADCAST_BATCH_SIZE,
+        rate=BROADCAST_RATE,
+        poll_interval=BROADCAST_POLL_INTERVAL,
+        send_timeout=BROADCAST_SEND_TIMEOUT,
+        max_attempts=BROADCAST_MAX_ATTEMPTS,
+    ):
+        self.bot = bot
+        self.batch_size = batch_size
+        self.rate = rate
+        self.poll_interval = poll_interval
+        self.send_timeout = send_timeout
+        self.max_attempts = max_attempts
+        self.thread = None
+        self._stopping = threading.Event()
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.finished = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="broadcasts", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=10):
+        self._stopping.set()
+        broadcasts_ready.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            broadcasts_ready.clear()
+            try:
+                has_more = self.send_next_batch()
+            except Exception as e:
+                logger.error(e)
+                has_more = False
+            if not has_more:
+                broadcasts_ready.wait(self.poll_interval)
+
+    def send_next_batch(self):
+        session = Session()
+        try:
+            broadcast = session.execute(
+                select(
+                    Broadcast.id,
+                    Broadcast.admin_id,
+                    Broadcast.text,
+                    Broadcast.buttons,
+                    Broadcast.screen,
+                    Broadcast.last_user_id,
+                )
+                .where(Broadcast.status == "running")
+                .order_by(Broadcast.id)
+                .limit(1)
+            ).first()
+            if broadcast is None:
+                return False
+            recipients = session.execute(
+                Broadcast.recipients(broadcast.screen, broadcast.last_user_id).limit(self.batch_size)
+            ).all()
+        finally:
+            session.close()
+        if not recipients:
+            self.finish(broadcast.id, broadcast.admin_id)
+            return True
+
+        keyboard = get_broadcast_keyboard(broadcast.buttons)
+        sent = 0
+        failed = 0
+        blocked = []
+        pending = recipients
+        for attempt in range(1, self.max_attempts + 1):
+            retry = []
+            retry_after = 0
+            for recipient, error in self.send_paced(broadcast, pending, keyboard):
+                if error is None:
+                    sent += 1
+                # 403: пользователь заблокировал бота или удалил аккаунт
+                elif getattr(error, "error_code", None) == 403:
+                    blocked.append(recipient.id)
+                elif is_retryable(error) and attempt < self.max_attempts:
+                    retry.append(recipient)
+                    retry_after = max(retry_after, get_retry_after(error))
+                else:
+                    logger.warning(f"Рассылка {broadcast.id} для {recipient.user_id} не доставлена: {error}")
+                    failed += 1
+            # 429 и временные ошибки повторяем до сохранения позиции, иначе
+            # эти получатели останутся без рассылки
+            if not retry or self._stopping.wait(retry_after):
+                break
+            pending = retry
+        if self._stopping.is_set():
+            # позиция не сохраняется, после перезапуска пачка уйдёт заново
+            return False
+
+        with session_scope() as session:
+            session.execute(
+                update(Broadcast)
+                .where(Broadcast.id == broadcast.id)
+                .values(
+                    last_user_id=recipients[-1].id,
+                    sent=Broadcast.sent + sent,
+                    failed=Broadcast.failed + failed,
+                    blocked=Broadcast.blocked + len(blocked),
+                )
+            )
+            if blocked:
+                session.execute(
+                    update(User).where(User.id.in_(blocked)).values(is_blocked=True)
+                )
+        self.sent += sent
+        self.failed += failed
+        self.blocked += len(blocked)
+        return True
+
+    def send_paced(self, broadcast, recipients, keyboard):
+        # Темп задаём сами, по одному сообщению: рассылка не должна занимать
+        # весь лимит отправителя и не должна зависеть от его очереди.
+        # Возвращает пары (получатель, ошибка) для поставленных сообщений.
+        sending = []
+        started_at = time.monotonic()
+        for index, recipient in enumerate(recipients):
+            delay = started_at + index / self.rate - time.monotonic()
+            if delay > 0 and self._stopping.wait(delay):
+                break
+            future = self.bot.send_message(
+                recipient.user_id,
+                broadcast.text,
+                reply_markup=keyboard,
+                parse_mode="HTML",
+                priority=BULK,
+            )
+            sending.append((recipient, future))
+        results = []
+        for recipient, future in sending:
+            try:
+                future.result(timeout=self.send_timeout)
+                results.append((recipient, None))
+            except Exception as e:
+                results.append((recipient, e))
+        return results
+
+    def finish(self, broadcast_id, admin_id):
+        with session_scope() as session:
+            session.execute(
+                update(Broadcast)
+                .where(Broadcast.id == broadcast_id)
+                .values(status="done", finished_at=datetime.now())
+            )
+            sent, failed, blocked = session.execute(
+                select(Broadcast.sent, Broadcast.failed, Broadcast.blocked).where(
+                    Broadcast.id == broadcast_id
+                )
+            ).one()
+        self.finished += 1
+        logger.info(f"Рассылка {broadcast_id} завершена: {sent} отправлено, {failed} ошибок, {blocked} заблокировали бота")
+        self.bot.send_message(
+            admin_id,
+            f"<b>Рассылка завершена</b>\nОтправлено: {sent}\nЗаблокировали бота: {blocked}\nОшибок: {failed}",
+            parse_mode="HTML",
+            priority=NOTIFICATION,
+        )
+
+    def stats(self):
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "blocked": self.blocked,
+            "finished": self.finished,
+        }
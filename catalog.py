@@ -0,0 +1,79 @@
+import threading
+from collections import namedtuple
+
+from database import Session, on_commit
+from models import Service
+
+CatalogService = namedtuple(
+    "CatalogService",
+    ["id", "age_category", "name", "description", "is_link", "link", "card"],
+)
+
+
+def render_card(service):
+    return f"<b>{service.name}</b>\n<b>Описание:</b>\n{service.description}\n<b>Возрастная категория: </b>{service.age_category.value}"
+
+
+class ServiceCatalog:
+    # Каталог меняется только из админки, поэтому держим его в памяти и
+    # перечитываем после save_service/DeleteService, которые увеличивают версию
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = 0
+        self._loaded_version = None
+        self._by_id = {}
+        self._by_age_category = {}
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+
+    def mark_changed(self, session):
+        # до коммита каталог ещё старый, поэтому экраны в той же транзакции
+        # читают услуги через session (см. MyServices)
+        session.info["catalog_changed"] = True
+        on_commit(session, self.invalidate)
+
+    def load(self):
+        with self._lock:
+            if self._loaded_version == self.version:
+                return
+            session = Session()
+            try:
+                services = session.query(Service).order_by(Service.id).all()
+            finally:
+                session.close()
+            by_id = {}
+            by_age_category = {}
+            for service in services:
+                catalog_service = CatalogService(
+                    id=service.id,
+                    age_category=service.age_category,
+                    name=service.name,
+                    description=service.description,
+                    is_link=service.is_link,
+                    link=service.link,
+                    card=render_card(service),
+                )
+                by_id[service.id] = catalog_service
+                by_age_category.setdefault(service.age_category.name, []).append(
+                    catalog_service
+                )
+            self._by_id = by_id
+            self._by_age_category = by_age_category
+            self._loaded_version = self.version
+
+    def get(self, service_id):
+        self.load()
+        return self._by_id.get(int(service_id))
+
+    def get_by_age_category(self, age_category):
+        self.load()
+        return self._by_age_category.get(age_category, [])
+
+    def all(self):
+        self.load()
+        return list(self._by_id.values())
+
+
+catalog = ServiceCatalog()
@@ -0,0 +1,186 @@
+import json
+import random
+import time
+from contextlib import contextmanager
+
+from loguru import logger
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker
+
+import config
+from config import BASE_NAME
+
+# Необязательные настройки, значения по умолчанию подходят для одного процесса бота
+SQL_ECHO = getattr(config, "SQL_ECHO", False)
+# доля SQL-запросов, попадающих в лог; полный echo слишком дорог для рабочего режима
+SQL_LOG_SAMPLE_RATE = getattr(config, "SQL_LOG_SAMPLE_RATE", 0.0)
+DB_POOL_SIZE = getattr(config, "DB_POOL_SIZE", 5)
+DB_MAX_OVERFLOW = getattr(config, "DB_MAX_OVERFLOW", 10)
+DB_POOL_TIMEOUT = getattr(config, "DB_POOL_TIMEOUT", 30)
+SQLITE_JOURNAL_MODE = getattr(config, "SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = getattr(config, "SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT = getattr(config, "SQLITE_BUSY_TIMEOUT", 5000)
+# для асинхронного режима, по умолчанию sqlite через aiosqlite
+ASYNC_BASE_NAME = getattr(config, "ASYNC_BASE_NAME", None)
+
+url = make_url(BASE_NAME)
+IS_SQLITE = url.get_backend_name() == "sqlite"
+
+
+def serialize_json(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def get_engine_options():
+    options = {
+        "echo": SQL_ECHO,
+        "pool_pre_ping": not IS_SQLITE,
+        "json_serializer": serialize_json,
+    }
+    # база в памяти работает на SingletonThreadPool, размер пула к нему не применим
+    if not (IS_SQLITE and url.database in (None, "", ":memory:")):
+        options["pool_size"] = DB_POOL_SIZE
+        options["max_overflow"] = DB_MAX_OVERFLOW
+        options["pool_timeout"] = DB_POOL_TIMEOUT
+    return options
+
+
+engine = create_engine(BASE_NAME, **get_engine_options())
+Session = sessionmaker(bind=engine)
+
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not IS_SQLITE:
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={int(SQLITE_BUSY_TIMEOUT)}")
+    cursor.close()
+
+
+def log_sampled_statement(conn, cursor, statement, parameters, context, executemany):
+    if random.random() < SQL_LOG_SAMPLE_RATE:
+        logger.info(f"SQL: {statement}")
+
+
+if SQL_LOG_SAMPLE_RATE:
+    event.listen(engine, "before_cursor_execute", log_sampled_statement)
+
+
+async_engine = None
+AsyncSession = None
+
+
+def get_async_session():
+    # движок создаётся лениво, чтобы синхронный режим не требовал aiosqlite
+    global async_engine, AsyncSession
+    if AsyncSession is None:
+        from sqlalchemy.ext.asyncio import (async_sessionmaker,
+                                            create_async_engine)
+        from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+        options = get_engine_options()
+        if ASYNC_BASE_NAME is not None:
+            async_url = ASYNC_BASE_NAME
+        else:
+            async_url = url.set(drivername="sqlite+aiosqlite")
+            if "pool_size" in options:
+                options["poolclass"] = AsyncAdaptedQueuePool
+        async_engine = create_async_engine(async_url, **options)
+        event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
+        AsyncSession = async_sessionmaker(async_engine, expire_on_commit=False)
+    return AsyncSession()
+
+
+async def dispose_async_engine():
+    if async_engine is not None:
+        await async_engine.dispose()
+
+
+def get_upsert(table):
+    # INSERT ... ON CONFLICT DO UPDATE есть в SQLite и PostgreSQL с одинаковым API
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table)
+
+
+def on_commit(session, callback):
+    session.info.setdefault("on_commit", []).append(callback)
+
+
+@event.listens_for(Session, "after_commit")
+def run_on_commit(session):
+    session.info.pop("user_states", None)
+    for callback in session.info.pop("on_commit", []):
+        try:
+            callback()
+        except Exception as e:
+            logger.error(e)
+
+
+@event.listens_for(Session, "after_rollback")
+def drop_on_commit(session):
+    session.info.pop("on_commit", None)
+    session.info.pop("user_states", None)
+
+
+@contextmanager
+def session_scope(session=None):
+    # внутри единицы работы используем её сессию, иначе открываем короткую
+    if session is not None:
+        yield session
+        return
+    session = Session()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+class UnitOfWork:
+    # одна сессия и одна транзакция на всю обработку обновления от Telegram
+    def __init__(self):
+        self.session = Session()
+        self.session.info["started_at"] = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.session.commit()
+            else:
+                self.session.rollback()
+        finally:
+            self.session.close()
+
+
+class QueryCounter:
+    # считает запросы к базе, например чтобы поймать N+1 в выгрузках
+    def __init__(self, bind=engine):
+        self.bind = bind
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.bind, "before_cursor_execute", self.before_cursor_execute)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event.remove(self.bind, "before_cursor_execute", self.before_cursor_execute)
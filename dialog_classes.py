@@ -1,19 +1,112 @@
-import json
+import threading
+from collections import OrderedDict
 
-import loguru
 from telebot import types
 from telebot.types import InlineKeyboardMarkup, ReplyKeyboardRemove
 
+import config
+from dispatcher import INTERACTIVE
+from metrics import metrics
 from models import User
 
+KEYBOARD_CACHE_SIZE = getattr(config, "KEYBOARD_CACHE_SIZE", 1024)
+
 
 class ValidationException(Exception):
     pass
 
 
+class KeyboardCache:
+    # хранит уже сериализованный reply_markup, telebot передаёт строку как есть
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._markups = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_build(self, key, build):
+        with self._lock:
+            markup = self._markups.get(key)
+            if markup is not None:
+                self._markups.move_to_end(key)
+                self.hits += 1
+                return markup
+            self.misses += 1
+        markup = build().to_json()
+        with self._lock:
+            self._markups[key] = markup
+            while len(self._markups) > self.max_size:
+                self._markups.popitem(last=False)
+        return markup
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._markups), "hits": self.hits, "misses": self.misses}
+
+
+keyboard_cache = KeyboardCache(KEYBOARD_CACHE_SIZE)
+
+
+def get_keyboard_spec(reply_buttons, inline_buttons):
+    if reply_buttons:
+        return ("reply", tuple(reply_buttons))
+    if inline_buttons:
+        return (
+            "inline",
+            tuple(
+                (button_label, button)
+                if type(button) == str
+                else (button_label, button["text"], button["url"])
+                for button_label, button in inline_buttons.items()
+            ),
+        )
+    return ("remove",)
+
+
+def build_keyboard(reply_buttons, inline_buttons):
+    if reply_buttons:
+        markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
+        buttons = [types.KeyboardButton(button) for button in reply_buttons]
+        markup.add(*buttons)
+        return markup
+    elif inline_buttons:
+        buttons = []
+        for button_label in inline_buttons:
+            if type(inline_buttons[button_label]) == str:
+                buttons.append(
+                    [
+                        types.InlineKeyboardButton(
+                            text=inline_buttons[button_label],
+                            callback_data=button_label,
+                        )
+                    ]
+                )
+            else:
+                buttons.append(
+                    [
+                        types.InlineKeyboardButton(
+                            text=inline_buttons[button_label]["text"],
+                            url=inline_buttons[button_label]["url"],
+                        )
+                    ]
+                )
+        return InlineKeyboardMarkup(buttons)
+    else:
+        return types.ReplyKeyboardRemove()
+
+
 class DialogClass:
     def __init__(
-        self, bot, user, dialog_name, state, context, users_message=None, callback=None
+        self,
+        bot,
+        user,
+        dialog_name,
+        state,
+        context,
+        users_message=None,
+        callback=None,
+        uow=None,
     ):
         self.user = user
         self.state = state
@@ -22,27 +115,108 @@ class DialogClass:
         self.callback = callback
         self.bot = bot
         self.context = context
+        self.uow = uow
 
     states = {}
+    # состояния, в которые попадают извне (reset_state, create_user);
+    # по умолчанию - первое состояние диалога
+    entry_states = None
 
-    def process_message(self):
-        states_names = list(self.states.keys())
-        next_state_index = states_names.index(self.state) + 1
-        if next_state_index < len(self.states):
-            next_state = f"@{states_names[next_state_index]}"
-        else:
-            next_state = None
-        state_processor = self.states.get(self.state)
-        if type(state_processor) != dict:
-            dialog_class = state_processor
-        else:
-            for str_options in state_processor:
-                options = str_options.split("__")
-                if "" in options or self.callback in options:
-                    dialog_class = state_processor[str_options]
-                    break
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.compile_states()
+
+    @classmethod
+    def compile_states(cls):
+        # таблицы переходов строятся один раз при объявлении диалога
+        states_names = list(cls.states)
+        cls.next_states = {}
+        cls.state_dispatch = {}
+        for index, state_name in enumerate(states_names):
+            if index + 1 < len(states_names):
+                cls.next_states[state_name] = f"@{states_names[index + 1]}"
             else:
-                raise Exception("Ошибка обработки состояния с аргументом")
+                cls.next_states[state_name] = None
+
+            state_processor = cls.states[state_name]
+            if type(state_processor) != dict:
+                state_processor = {"": state_processor}
+            options_map = {}
+            default = None
+            for str_options, dialog_class in state_processor.items():
+                if default is not None:
+                    raise Exception(
+                        f"{cls.__name__}: вариант {str_options!r} состояния {state_name!r} недостижим"
+                    )
+                for option in str_options.split("__"):
+                    if option == "":
+                        default = dialog_class
+                    else:
+                        options_map.setdefault(option, dialog_class)
+            cls.state_dispatch[state_name] = (options_map, default)
+
+        for options_map, default in cls.state_dispatch.values():
+            for dialog_class in [*options_map.values(), default]:
+                if dialog_class is None:
+                    continue
+                if not issubclass(dialog_class, StateProcessorClass):
+                    raise Exception(f"{cls.__name__}: {dialog_class!r} не обработчик состояния")
+                redirect_next_state = dialog_class.redirect_next_state
+                if (
+                    redirect_next_state is not None
+                    and redirect_next_state[0] == "@"
+                    and redirect_next_state[1:] not in cls.states
+                ):
+                    raise Exception(
+                        f"{cls.__name__}: состояние {redirect_next_state!r} из {dialog_class.__name__} не найдено"
+                    )
+        cls.check_reachable()
+
+    @classmethod
+    def check_reachable(cls):
+        # Переходы берутся из next_state после __init__ обработчика и из
+        # redirect_next_state. Переходы, заданные в business_logic, не видны,
+        # поэтому их цели нужно перечислить в entry_states.
+        transitions = {}
+        for state_name, (options_map, default) in cls.state_dispatch.items():
+            targets = set()
+            for dialog_class in {*options_map.values(), default}:
+                if dialog_class is None:
+                    continue
+                next_state = dialog_class(
+                    user=None,
+                    bot=None,
+                    dialog_name=None,
+                    next_state=cls.next_states[state_name],
+                    context={},
+                ).next_state
+                for target in (next_state, dialog_class.redirect_next_state):
+                    if target is not None and target[0] == "@":
+                        targets.add(target[1:])
+            transitions[state_name] = targets
+
+        reachable = set(cls.entry_states or list(cls.states)[:1])
+        pending = list(reachable)
+        while pending:
+            for target in transitions.get(pending.pop(), ()):
+                if target not in reachable:
+                    reachable.add(target)
+                    pending.append(target)
+        unreachable = [state_name for state_name in cls.states if state_name not in reachable]
+        if unreachable:
+            raise Exception(f"{cls.__name__}: состояния {unreachable} недостижимы")
+
+    @classmethod
+    def get_state_processor(cls, state, callback):
+        options_map, default = cls.state_dispatch[state]
+        dialog_class = options_map.get(callback, default)
+        if dialog_class is None:
+            raise Exception("Ошибка обработки состояния с аргументом")
+        return dialog_class
+
+    def process_message(self):
+        next_state = self.next_states[self.state]
+        dialog_class = self.get_state_processor(self.state, self.callback)
         state_processor_object = dialog_class(
             user=self.user,
             bot=self.bot,
@@ -51,6 +225,7 @@ class DialogClass:
             context=self.context,
             users_message=self.users_message,
             callback=self.callback,
+            uow=self.uow,
         )
         try:
             state_processor_object.process()
@@ -68,6 +243,7 @@ class StateProcessorClass:
         context,
         users_message=None,
         callback=None,
+        uow=None,
     ):
         self.user = user
         self.bot = bot
@@ -75,7 +251,13 @@ class StateProcessorClass:
         self.callback = callback
         self.dialog_name = dialog_name
         self.next_state = next_state
+        self.next_context = None
         self.context = context
+        self.uow = uow
+
+    @property
+    def session(self):
+        return self.uow.session
 
     invalid_message = "некорректный ответ"
 
@@ -105,78 +287,70 @@ class StateProcessorClass:
     def get_message_text(self):
         return self.text_message
 
+    def get_keyboard_cache_key(self):
+        # динамические экраны могут вернуть свой ключ, тогда кнопки не пересчитываются
+        return None
+
     def get_keyboard(self):
+        cache_key = self.get_keyboard_cache_key()
+        if cache_key is not None:
+            return keyboard_cache.get_or_build(
+                cache_key,
+                lambda: build_keyboard(self.get_reply_buttons(), self.get_inline_buttons()),
+            )
         reply_buttons = self.get_reply_buttons()
         inline_buttons = self.get_inline_buttons()
-        if reply_buttons != []:
-            markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-            buttons = [types.KeyboardButton(button) for button in reply_buttons]
-            markup.add(*buttons)
-            return markup
-        elif inline_buttons != {}:
-            buttons = []
-            for button_label in inline_buttons:
-                if type(inline_buttons[button_label]) == str:
-                    buttons.append(
-                        [
-                            types.InlineKeyboardButton(
-                                text=inline_buttons[button_label],
-                                callback_data=button_label,
-                            )
-                        ]
-                    )
-                else:
-                    buttons.append(
-                        [
-                            types.InlineKeyboardButton(
-                                text=inline_buttons[button_label]["text"],
-                                url=inline_buttons[button_label]["url"],
-                            )
-                        ]
-                    )
-            reply_markup = InlineKeyboardMarkup(buttons)
-            return reply_markup
-        else:
-            return types.ReplyKeyboardRemove()
+        return keyboard_cache.get_or_build(
+            get_keyboard_spec(reply_buttons, inline_buttons),
+            lambda: build_keyboard(reply_buttons, inline_buttons),
+        )
 
-    def send_message(self, user_id=None, message_text=None, keyboard=None):
+    def send_message(self, user_id=None, message_text=None, keyboard=None, priority=INTERACTIVE):
         if user_id is None:
             user_id = self.user.id
         if message_text is None:
             message_text = self.get_message_text()
         if keyboard is None:
-            self.bot.send_message(
-                user_id,
-                message_text,
-                reply_markup=ReplyKeyboardRemove(),
-                parse_mode="HTML",
-            )
-        else:
-            self.bot.send_message(
-                user_id,
-                message_text,
-                reply_markup=keyboard,
-                parse_mode="HTML",
-            )
+            keyboard = keyboard_cache.get_or_build(("remove",), ReplyKeyboardRemove)
+        return self.bot.send_message(
+            user_id,
+            message_text,
+            reply_markup=keyboard,
+            parse_mode="HTML",
+            priority=priority,
+        )
+
     document = None
+    document_name = None
 
-    def send_document(self, document=None, user_id=None):
+    def send_document(self, document=None, user_id=None, priority=INTERACTIVE):
         if user_id is None:
             user_id = self.user.id
         if document is None:
             document = self.document
-        self.bot.send_document(user_id, document=document)
+        self.bot.send_document(
+            user_id,
+            document=document,
+            visible_file_name=self.document_name,
+            priority=priority,
+        )
 
     def change_user_state(self):
         if self.next_state[0] == "@":
-            next_state = f"{self.dialog_name}__{self.next_state[1:]}"
+            dialog_name, next_state = self.dialog_name, self.next_state[1:]
         else:
-            next_state = self.next_state
-        User.set_state(self.user.id, next_state, self.user.username)
+            dialog_name, next_state = self.next_state.split("__", 1)
+        User.set_state(
+            self.user.id,
+            dialog_name,
+            next_state,
+            self.user.username,
+            context=self.next_context,
+            session=self.session,
+        )
 
     def set_context(self, context):
-        context_json = json.dumps(context)
-        self.next_state = f"{self.next_state}__{context_json}"
+        self.next_context = context
 
     def business_logic(self):
         pass
@@ -185,10 +359,15 @@ class StateProcessorClass:
     redirect_next_state = None
 
     def process(self):
-        if self.is_valid():
-            self.business_logic()
+        labels = {"dialog": self.dialog_name, "state": type(self).__name__}
+        with metrics.timed("is_valid", **labels):
+            is_valid = self.is_valid()
+        if is_valid:
+            with metrics.timed("business_logic", **labels):
+                self.business_logic()
             self.send_message(keyboard=self.get_keyboard())
-            self.change_user_state()
+            with metrics.timed("change_user_state", **labels):
+                self.change_user_state()
             if self.document is not None:
                 self.send_document()
             if self.redirect_class is not None:
@@ -200,6 +379,7 @@ class StateProcessorClass:
                     context=self.context,
                     users_message=self.users_message,
                     callback=self.callback,
+                    uow=self.uow,
                 ).process()
 
         else:
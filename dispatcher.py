@@ -0,0 +1,392 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import requests
+from loguru import logger
+
+import config
+from metrics import metrics
+
+try:
+    import aiohttp
+    from telebot.asyncio_helper import RequestTimeout
+except ImportError:
+    # aiohttp нужен только для async_main.py
+    aiohttp = None
+
+# Ограничения Telegram: около 30 сообщений в секунду на бота и около
+# одного сообщения в секунду в один чат (допускается короткий всплеск)
+DISPATCHER_SENDERS = getattr(config, "DISPATCHER_SENDERS", 4)
+DISPATCHER_GLOBAL_RATE = getattr(config, "DISPATCHER_GLOBAL_RATE", 25)
+DISPATCHER_GLOBAL_BURST = getattr(config, "DISPATCHER_GLOBAL_BURST", 25)
+DISPATCHER_CHAT_RATE = getattr(config, "DISPATCHER_CHAT_RATE", 1)
+DISPATCHER_CHAT_BURST = getattr(config, "DISPATCHER_CHAT_BURST", 3)
+DISPATCHER_MAX_RETRIES = getattr(config, "DISPATCHER_MAX_RETRIES", 5)
+
+# Приоритеты: меньше - раньше
+INTERACTIVE = 0
+NOTIFICATION = 1
+BULK = 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", NOTIFICATION: "notification", BULK: "bulk"}
+
+CHAT_BUCKETS_LIMIT = 10000
+
+NETWORK_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    asyncio.TimeoutError,
+    FutureTimeoutError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+)
+if aiohttp is not None:
+    # асинхронный telebot заворачивает ошибки aiohttp в RequestTimeout
+    NETWORK_ERRORS += (aiohttp.ClientConnectionError, aiohttp.ServerTimeoutError, RequestTimeout)
+
+
+def is_retryable(error):
+    # 429, ошибки сервера Telegram и сетевые ошибки проходят со временем;
+    # остальные 4xx (например, 400 из-за разметки) и ошибки в коде
+    # повторять бесполезно
+    error_code = getattr(error, "error_code", None)
+    if error_code is not None:
+        return error_code == 429 or error_code >= 500
+    return isinstance(error, NETWORK_ERRORS)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def wait_time(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+
+class OutboundMessage:
+    def __init__(self, priority, seq, method, chat_id, args, kwargs):
+        self.priority = priority
+        self.seq = seq
+        self.method = method
+        self.chat_id = chat_id
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+        self.not_before = 0
+        self.attempts = 0
+
+
+class OutboundDispatcher:
+    # Обработчики ставят сообщения в очередь и не ждут Telegram. Потоки-отправители
+    # соблюдают общий лимит и лимит на чат, повторяют запросы после 429 и
+    # отправляют интерактивные ответы раньше уведомлений и рассылок.
+    # Сообщения одного чата с одним приоритетом уходят строго по порядку.
+    def __init__(
+        self,
+        bot,
+        senders=DISPATCHER_SENDERS,
+        global_rate=DISPATCHER_GLOBAL_RATE,
+        global_burst=DISPATCHER_GLOBAL_BURST,
+        chat_rate=DISPATCHER_CHAT_RATE,
+        chat_burst=DISPATCHER_CHAT_BURST,
+        max_retries=DISPATCHER_MAX_RETRIES,
+    ):
+        self.bot = bot
+        self.senders = senders
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global_bucket = TokenBucket(global_rate, global_burst)
+        self._chat_buckets = {}
+        self._queue = []
+        self._in_flight = set()
+        self._seq = itertools.count()
+        self._condition = threading.Condition()
+        self._stopping = False
+        self.threads = []
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.throttled = 0
+        self.latency_count = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.wait_count = 0
+        self.wait_sum = 0.0
+        self.wait_max = 0.0
+
+    def send_message(self, chat_id, *args, priority=INTERACTIVE, **kwargs):
+        return self.enqueue("send_message", chat_id, args, kwargs, priority)
+
+    def send_document(self, chat_id, *args, priority=INTERACTIVE, **kwargs):
+        return self.enqueue("send_document", chat_id, args, kwargs, priority)
+
+    def enqueue(self, method, chat_id, args, kwargs, priority=INTERACTIVE):
+        item = OutboundMessage(priority, next(self._seq), method, chat_id, args, kwargs)
+        with self._condition:
+            heapq.heappush(self._queue, (item.priority, item.seq, item))
+            self._wake()
+        return item.future
+
+    def _wake(self, everyone=False):
+        # вызывается под self._condition
+        if everyone:
+            self._condition.notify_all()
+        else:
+            self._condition.notify()
+
+    def start(self):
+        for index in range(self.senders):
+            thread = threading.Thread(
+                target=self._run, name=f"outbound-{index}", daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=10):
+        # дожидаемся отправки уже поставленных сообщений
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= CHAT_BUCKETS_LIMIT:
+                self._prune_chat_buckets()
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _prune_chat_buckets(self):
+        now = time.monotonic()
+        waiting = {item.chat_id for _, _, item in self._queue} | self._in_flight
+        for chat_id, bucket in list(self._chat_buckets.items()):
+            bucket.wait_time(now)
+            if chat_id not in waiting and bucket.tokens >= bucket.burst:
+                del self._chat_buckets[chat_id]
+
+    def _pick(self, now):
+        # вызывается под self._condition; возвращает сообщение, которое можно
+        # отправить сейчас, или время до следующей проверки
+        skipped = []
+        blocked = set()
+        chosen = None
+        timeout = None
+        while self._queue:
+            entry = heapq.heappop(self._queue)
+            item = entry[2]
+            if item.chat_id in blocked or item.chat_id in self._in_flight:
+                blocked.add(item.chat_id)
+                skipped.append(entry)
+                continue
+            delay = max(
+                item.not_before - now,
+                self._chat_bucket(item.chat_id).wait_time(now),
+            )
+            if delay > 0:
+                blocked.add(item.chat_id)
+                skipped.append(entry)
+                timeout = delay if timeout is None else min(timeout, delay)
+                continue
+            chosen = entry
+            break
+        for entry in skipped:
+            heapq.heappush(self._queue, entry)
+
+        if chosen is not None:
+            delay = self._global_bucket.wait_time(now)
+            if delay <= 0:
+                item = chosen[2]
+                self._global_bucket.consume()
+                self._chat_bucket(item.chat_id).consume()
+                self._in_flight.add(item.chat_id)
+                if item.attempts == 0:
+                    self._record_wait(item, now)
+                return item, None
+            heapq.heappush(self._queue, chosen)
+            timeout = delay
+        return None, timeout
+
+    def _record_wait(self, item, now):
+        # время в очереди до первой попытки, без самой отправки и повторов
+        wait = now - item.enqueued_at
+        self.wait_count += 1
+        self.wait_sum += wait
+        self.wait_max = max(self.wait_max, wait)
+        metrics.observe(
+            "outbound_wait", wait, priority=PRIORITY_NAMES.get(item.priority, str(item.priority))
+        )
+
+    def _take(self):
+        with self._condition:
+            while True:
+                if self._stopping and not self._queue:
+                    return None
+                item, timeout = self._pick(time.monotonic())
+                if item is not None:
+                    return item
+                self._condition.wait(timeout)
+
+    def _run(self):
+        while True:
+            item = self._take()
+            if item is None:
+                return
+            try:
+                self._send(item)
+            finally:
+                with self._condition:
+                    self._in_flight.discard(item.chat_id)
+                    self._wake(everyone=True)
+
+    def _send(self, item):
+        item.attempts += 1
+        try:
+            with metrics.timed("telegram_api", method=item.method):
+                result = getattr(self.bot, item.method)(item.chat_id, *item.args, **item.kwargs)
+        except Exception as e:
+            self._handle_error(item, e)
+        else:
+            self._finish(item, result=result)
+
+    def _handle_error(self, item, error):
+        # исключения синхронного и асинхронного telebot разные, поэтому
+        # ошибку Bot API узнаём по коду
+        error_code = getattr(error, "error_code", None)
+        if error_code == 429 and item.attempts <= self.max_retries:
+            retry_after = (error.result_json.get("parameters") or {}).get("retry_after", 1)
+            with self._condition:
+                self.throttled += 1
+            self._retry(item, retry_after)
+            return
+        # ошибки сервера и сети повторяем с экспоненциальной задержкой
+        if is_retryable(error) and item.attempts <= self.max_retries:
+            self._retry(item, min(2 ** item.attempts, 30))
+            return
+        self._finish(item, error=error)
+
+    def _retry(self, item, delay):
+        document = item.kwargs.get("document")
+        if hasattr(document, "seek"):
+            document.seek(0)
+        item.not_before = time.monotonic() + delay
+        with self._condition:
+            self.retried += 1
+            heapq.heappush(self._queue, (item.priority, item.seq, item))
+
+    def _finish(self, item, result=None, error=None):
+        latency = time.monotonic() - item.enqueued_at
+        with self._condition:
+            if error is None:
+                self.sent += 1
+            else:
+                self.failed += 1
+            self.latency_count += 1
+            self.latency_sum += latency
+            self.latency_max = max(self.latency_max, latency)
+        if error is None:
+            item.future.set_result(result)
+        else:
+            logger.error(f"Не удалось отправить {item.method} в чат {item.chat_id}: {error}")
+            item.future.set_exception(error)
+
+    def stats(self):
+        with self._condition:
+            queued = {name: 0 for name in PRIORITY_NAMES.values()}
+            for _, _, item in self._queue:
+                queued[PRIORITY_NAMES.get(item.priority, str(item.priority))] += 1
+            return {
+                "queued": queued,
+                "in_flight": len(self._in_flight),
+                "sent": self.sent,
+                "failed": self.failed,
+                "retried": self.retried,
+                "throttled": self.throttled,
+                "latency_avg": self.latency_sum / self.latency_count if self.latency_count else 0,
+                "latency_max": self.latency_max,
+                "wait_avg": self.wait_sum / self.wait_count if self.wait_count else 0,
+                "wait_max": self.wait_max,
+            }
+
+
+class AsyncOutboundDispatcher(OutboundDispatcher):
+    # Очередь, лимиты, приоритеты и повторы те же, что у OutboundDispatcher,
+    # но отправители - задачи asyncio, вызывающие AsyncTeleBot. Ставить
+    # сообщения можно из любого потока, результат возвращается в Future.
+    def __init__(self, bot, loop, **kwargs):
+        super().__init__(bot, **kwargs)
+        self.loop = loop
+        self._wakeup = asyncio.Event()
+        self.tasks = []
+
+    def _wake(self, everyone=False):
+        self.loop.call_soon_threadsafe(self._wakeup.set)
+
+    def start(self):
+        for index in range(self.senders):
+            self.tasks.append(self.loop.create_task(self._run_async()))
+
+    async def stop_async(self, timeout=10):
+        # дожидаемся отправки уже поставленных сообщений
+        with self._condition:
+            self._stopping = True
+        self._wakeup.set()
+        if self.tasks:
+            await asyncio.wait(self.tasks, timeout=timeout)
+
+    async def _take_async(self):
+        while True:
+            with self._condition:
+                if self._stopping and not self._queue:
+                    return None
+                item, timeout = self._pick(time.monotonic())
+                if item is not None:
+                    return item
+                # новое сообщение после clear() снова выставит событие
+                self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_async(self):
+        while True:
+            item = await self._take_async()
+            if item is None:
+                return
+            try:
+                await self._send_async(item)
+            finally:
+                with self._condition:
+                    self._in_flight.discard(item.chat_id)
+                    self._wake(everyone=True)
+
+    async def _send_async(self, item):
+        item.attempts += 1
+        try:
+            with metrics.timed("telegram_api", method=item.method):
+                result = await getattr(self.bot, item.method)(
+                    item.chat_id, *item.args, **item.kwargs
+                )
+        except Exception as e:
+            self._handle_error(item, e)
+        else:
+            self._finish(item, result=result)
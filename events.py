@@ -0,0 +1,101 @@
+import atexit
+import threading
+from datetime import datetime
+
+from loguru import logger
+
+import config
+
+TRANSITION_LOG_ENABLED = getattr(config, "TRANSITION_LOG_ENABLED", True)
+TRANSITION_LOG_BATCH_SIZE = getattr(config, "TRANSITION_LOG_BATCH_SIZE", 500)
+TRANSITION_LOG_FLUSH_INTERVAL = getattr(config, "TRANSITION_LOG_FLUSH_INTERVAL", 5.0)
+# если база недоступна, лишние события отбрасываются, а не копятся в памяти
+TRANSITION_LOG_MAX_BUFFER = getattr(config, "TRANSITION_LOG_MAX_BUFFER", 100000)
+
+
+class TransitionLog:
+    # События переходов копятся в памяти и пишутся в базу пачками из
+    # фонового потока, обработка сообщения не ждёт этой записи
+    def __init__(self, batch_size, max_buffer):
+        self.batch_size = batch_size
+        self.max_buffer = max_buffer
+        self.running = False
+        self._buffer = []
+        self._lock = threading.Lock()
+        self.ready = threading.Event()
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+
+    def record(self, user_id, current, new_state, latency=None):
+        if not self.running:
+            return
+        event = {
+            "user_id": user_id,
+            "from_dialog": current.dialog,
+            "from_state": current.state,
+            "to_dialog": new_state.dialog,
+            "to_state": new_state.state,
+            "created_at": datetime.now(),
+            "latency_ms": None if latency is None else int(latency * 1000),
+        }
+        with self._lock:
+            if len(self._buffer) >= self.max_buffer:
+                self.dropped += 1
+                return
+            self._buffer.append(event)
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self.ready.set()
+
+    def flush(self, write):
+        with self._lock:
+            events, self._buffer = self._buffer, []
+        if not events:
+            return
+        try:
+            for start in range(0, len(events), self.batch_size):
+                write(events[start:start + self.batch_size])
+                with self._lock:
+                    self.written += len(events[start:start + self.batch_size])
+                    self.flushes += 1
+        except Exception:
+            with self._lock:
+                self._buffer = events[start:] + self._buffer
+                overflow = len(self._buffer) - self.max_buffer
+                if overflow > 0:
+                    del self._buffer[:overflow]
+                    self.dropped += overflow
+            raise
+
+    def stats(self):
+        with self._lock:
+            return {
+                "buffered": len(self._buffer),
+                "written": self.written,
+                "dropped": self.dropped,
+                "flushes": self.flushes,
+            }
+
+
+def start_transition_log(log, write, interval):
+    def flush():
+        try:
+            log.flush(write)
+        except Exception as e:
+            logger.error(f"Ошибка записи журнала переходов: {e}")
+
+    def loop():
+        while True:
+            log.ready.wait(interval)
+            log.ready.clear()
+            flush()
+
+    log.running = True
+    thread = threading.Thread(target=loop, name="transition-log-flush", daemon=True)
+    thread.start()
+    atexit.register(flush)
+    return thread
+
+
+transition_log = TransitionLog(TRANSITION_LOG_BATCH_SIZE, TRANSITION_LOG_MAX_BUFFER)
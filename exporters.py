@@ -0,0 +1,147 @@
+import csv
+import io
+import tempfile
+
+from openpyxl import Workbook
+from sqlalchemy import select
+
+import config
+from models import Appointment, Service, User
+from user_services import UserServices
+
+EXPORT_FORMAT = getattr(config, "EXPORT_FORMAT", "xlsx")
+EXPORT_CHUNK_SIZE = getattr(config, "EXPORT_CHUNK_SIZE", 1000)
+
+
+class XlsxWriter:
+    extension = "xlsx"
+
+    def __init__(self, file):
+        self.file = file
+        # в режиме write_only openpyxl не держит лист в памяти
+        self.workbook = Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet()
+
+    def write_row(self, row):
+        self.sheet.append(row)
+
+    def close(self):
+        self.workbook.save(self.file)
+
+
+class CsvWriter:
+    extension = "csv"
+
+    def __init__(self, file):
+        # BOM и ";" нужны, чтобы Excel сразу открыл файл с кириллицей по колонкам
+        self.text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+        self.writer = csv.writer(self.text, delimiter=";")
+
+    def write_row(self, row):
+        self.writer.writerow(row)
+
+    def close(self):
+        self.text.flush()
+        self.text.detach()
+
+
+WRITERS = {
+    XlsxWriter.extension: XlsxWriter,
+    CsvWriter.extension: CsvWriter,
+}
+
+
+def export_rows(title, header, rows, export_format=EXPORT_FORMAT, file=None):
+    # строки пишутся по одной во временный файл на диске, поэтому память
+    # не зависит от размера выгрузки
+    if file is None:
+        file = tempfile.TemporaryFile()
+    try:
+        writer = WRITERS[export_format](file)
+        writer.write_row(header)
+        for row in rows:
+            writer.write_row(row)
+        writer.close()
+    except Exception:
+        file.close()
+        raise
+    file.seek(0)
+    return file, f"{title}.{writer.extension}"
+
+
+APPOINTMENTS_HEADER = [
+    "Алиас",
+    "Имя",
+    "Услуга",
+    "Описание проблемы",
+    "Запрос",
+    "Номер телефона",
+    "Дата",
+]
+
+
+def appointment_rows(session, since_date, until_date):
+    # название услуги берётся тем же запросом, без отдельной загрузки на строку
+    appointments = session.execute(
+        select(
+            Appointment.username,
+            Appointment.client_name,
+            Service.name,
+            Appointment.problem_description,
+            Appointment.request,
+            Appointment.phone_number,
+            Appointment.date,
+        )
+        .outerjoin(Appointment.service)
+        .where(Appointment.date > since_date, Appointment.date < until_date)
+        .order_by(Appointment.date, Appointment.id)
+        .execution_options(yield_per=EXPORT_CHUNK_SIZE)
+    )
+    for username, client_name, service_name, problem, request, phone_number, date in appointments:
+        yield [
+            username,
+            client_name,
+            "Удаленная услуга" if service_name is None else service_name,
+            problem,
+            request,
+            phone_number,
+            date.strftime("%d.%m.%Y"),
+        ]
+
+
+def export_appointments(session, since_date, until_date, export_format=EXPORT_FORMAT, file=None):
+    return export_rows(
+        "Запись на консультации",
+        APPOINTMENTS_HEADER,
+        appointment_rows(session, since_date, until_date),
+        export_format,
+        file,
+    )
+
+
+USER_STATISTICS_HEADER = ["Алиас", "ID", "Текущий шаг"]
+
+
+def user_statistics_rows(session):
+    users = session.execute(
+        select(User.username, User.user_id, User.previous_dialog, User.previous_state)
+        .where(User.previous_dialog.is_not(None), User.previous_state.is_not(None))
+        .order_by(User.id)
+        .execution_options(yield_per=EXPORT_CHUNK_SIZE)
+    )
+    for username, user_id, previous_dialog, previous_state in users:
+        if previous_dialog == "admin_services":
+            step = "Админ меню"
+        else:
+            step = UserServices.states[previous_state].SCREEN_NAME
+        yield [username, user_id, step]
+
+
+def export_user_statistics(session, export_format=EXPORT_FORMAT, file=None):
+    return export_rows(
+        "Статистика пользователей",
+        USER_STATISTICS_HEADER,
+        user_statistics_rows(session),
+        export_format,
+        file,
+    )
@@ -0,0 +1,82 @@
+import logging
+import sys
+
+from loguru import logger
+from telebot import logger as telebot_logger
+
+import config
+
+# Все приёмники логов работают через очередь (enqueue=True): запись на диск
+# и в консоль идёт в отдельном потоке и не задерживает обработку обновлений
+LOG_LEVEL = getattr(config, "LOG_LEVEL", "INFO")
+LOG_JSON = getattr(config, "LOG_JSON", False)
+# уровни для отдельных модулей, например {"dispatcher": "WARNING", "telebot": "ERROR"}
+LOG_MODULE_LEVELS = getattr(config, "LOG_MODULE_LEVELS", {})
+LOGFILE = getattr(config, "LOGFILE", None)
+LOGFILE_LEVEL = getattr(config, "LOGFILE_LEVEL", "ERROR")
+LOGFILE_JSON = getattr(config, "LOGFILE_JSON", True)
+LOGFILE_ROTATION = getattr(config, "LOGFILE_ROTATION", "400KB")
+
+LOG_FORMAT = "{time:YYYY-MM-DD HH:mm:ss.SSS} | {level: <8} | {name}:{function}:{line} - {message}"
+
+
+class InterceptHandler(logging.Handler):
+    # переводит записи стандартного logging (telebot, sqlalchemy) в loguru
+    def emit(self, record):
+        try:
+            level = logger.level(record.levelname).name
+        except ValueError:
+            level = record.levelno
+        frame, depth = sys._getframe(6), 6
+        while frame and frame.f_code.co_filename == logging.__file__:
+            frame = frame.f_back
+            depth += 1
+        logger.opt(depth=depth, exception=record.exc_info).log(level, record.getMessage())
+
+
+def get_filter(level):
+    return {"": level, **LOG_MODULE_LEVELS}
+
+
+def get_min_level(level):
+    # Нижний уровень приёмника с учётом LOG_MODULE_LEVELS: записи ниже него
+    # отбрасываются сразу, без фильтра и перехвата из logging
+    levels = []
+    for value in [level, *LOG_MODULE_LEVELS.values()]:
+        if value is False:
+            continue
+        if value is True:
+            value = 0
+        elif isinstance(value, str):
+            value = logger.level(value).no
+        levels.append(value)
+    return min(levels)
+
+
+def setup_logging():
+    logger.remove()
+    min_level = get_min_level(LOG_LEVEL)
+    logger.add(
+        sys.stderr,
+        level=min_level,
+        filter=get_filter(LOG_LEVEL),
+        format=LOG_FORMAT,
+        serialize=LOG_JSON,
+        enqueue=True,
+    )
+    if LOGFILE:
+        min_level = min(min_level, get_min_level(LOGFILE_LEVEL))
+        logger.add(
+            LOGFILE,
+            level=get_min_level(LOGFILE_LEVEL),
+            filter=get_filter(LOGFILE_LEVEL),
+            format=LOG_FORMAT,
+            serialize=LOGFILE_JSON,
+            rotation=LOGFILE_ROTATION,
+            compression="zip",
+            enqueue=True,
+        )
+    logging.basicConfig(handlers=[InterceptHandler()], level=min_level, force=True)
+    # у telebot свой обработчик, пишущий в консоль напрямую
+    telebot_logger.handlers = []
+    telebot_logger.propagate = True
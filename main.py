@@ -1,48 +1,24 @@
-import json
-
 import telebot
 from loguru import logger
 from telebot.types import BotCommand
 
-from admin_services import AdminServices
 from config import ADMINS, BOT_TOKEN
-from models import User
-from user_services import UserServices
-
-bot = telebot.TeleBot(BOT_TOKEN)
-
-dialog_classes_router = {
-    "admin_services": AdminServices,
-    "user_services": UserServices,
-}
+from dispatcher import OutboundDispatcher
+from metrics import metrics
+from router import process_update
+from services import BackgroundServices
+from webhook import WEBHOOK_ENABLED, run_webhook
+from worker_pool import create_worker_pool
 
-def routing(user, users_message=None, callback=None, command=None):
+# параллельность обеспечивает worker_pool, сам telebot вызывает обработчики по очереди
+bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
+outbound = OutboundDispatcher(bot)
+worker_pool = create_worker_pool()
+services = BackgroundServices(outbound, worker_pool)
 
-    state_arguments = User.get_state(user.id).split("__")
 
-    context = json.loads(state_arguments[2]) if len(state_arguments) > 2 else {}
-    state = state_arguments[1] if len(state_arguments) > 1 else None
-
-    state_processor = dialog_classes_router[state_arguments[0]]
-    if type(state_processor) != dict:
-        dialog_class = state_processor
-    else:
-        for str_options in state_processor:
-            options = str_options.split("__")
-            if "" in options or callback in options:
-                dialog_class = state_processor[str_options]
-                break
-        else:
-            raise Exception("Ошибка обработки состояния с аргументом")
-    dialog_class(
-        bot=bot,
-        user=user,
-        dialog_name=state_arguments[0],
-        state=state,
-        context=context,
-        users_message=users_message,
-        callback=callback,
-    ).process_message()
+def routing(user, users_message=None, callback=None, command=None, reset_state=None, start=False):
+    process_update(outbound, user, users_message, callback, reset_state, start)
 
 
 def update_commands(user_id):
@@ -51,38 +27,83 @@ def update_commands(user_id):
     ]
     if user_id in ADMINS:
         commands.append(BotCommand(command="/admin_menu", description="Меню администратора"))
+        commands.append(BotCommand(command="/metrics", description="Метрики бота"))
     bot.set_my_commands(commands)
 
 
+def start_dialog(user):
+    update_commands(user.id)
+    routing(user, command="menu", start=True)
+
+
+def submit(user_id, function, *args, **kwargs):
+    if worker_pool is None:
+        function(*args, **kwargs)
+    else:
+        worker_pool.submit(user_id, function, *args, **kwargs)
+
+
 @bot.message_handler(commands=["start"])
 def send_welcome(message):
-    update_commands(message.from_user.id)
-    User.create_user(message.from_user.id)
-    routing(message.from_user, command="menu")
+    submit(message.from_user.id, start_dialog, message.from_user)
 
 
 @bot.message_handler(commands=["menu"])
 def send_welcome(message):
-    User.set_state(message.from_user.id, "user_services__menu", message.from_user.username)
-    routing(message.from_user, command="menu")
+    submit(
+        message.from_user.id,
+        routing,
+        message.from_user,
+        command="menu",
+        reset_state=("user_services", "menu"),
+    )
 
 
 @bot.message_handler(commands=["admin_menu"])
 def send_welcome(message):
     if message.from_user.id in ADMINS:
-        User.set_state(message.from_user.id, "admin_services__my_services", message.from_user.username)
-        routing(message.from_user, command="menu")
+        submit(
+            message.from_user.id,
+            routing,
+            message.from_user,
+            command="menu",
+            reset_state=("admin_services", "my_services"),
+        )
+
+
+@bot.message_handler(commands=["metrics"])
+def send_metrics(message):
+    if message.from_user.id in ADMINS:
+        outbound.send_message(message.from_user.id, metrics.summary())
 
 
 @bot.message_handler(func=lambda message: True)
 def message_router(message):
-    routing(message.from_user, users_message=message.text)
+    submit(message.from_user.id, routing, message.from_user, users_message=message.text)
 
 
 @bot.callback_query_handler(func=lambda call: True)
 def callback_handler(call):
-    routing(call.from_user, callback=call.data)
+    submit(call.from_user.id, routing, call.from_user, callback=call.data)
+
+
+def start_services():
+    services.start()
+    outbound.start()
+
+
+def stop_services():
+    services.stop()
+    outbound.stop()
+    logger.complete()
 
 
 if __name__ == "__main__":
-    bot.infinity_polling()
+    start_services()
+    try:
+        if WEBHOOK_ENABLED:
+            run_webhook(bot)
+        else:
+            bot.infinity_polling()
+    finally:
+        stop_services()
@@ -0,0 +1,190 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from loguru import logger
+
+import config
+
+# Prometheus забирает метрики с http://METRICS_HOST:METRICS_PORT/metrics
+METRICS_ENABLED = getattr(config, "METRICS_ENABLED", True)
+METRICS_HOST = getattr(config, "METRICS_HOST", "127.0.0.1")
+METRICS_PORT = getattr(config, "METRICS_PORT", 9108)
+METRICS_BUCKETS = getattr(
+    config,
+    "METRICS_BUCKETS",
+    (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+METRICS_PREFIX = "consultations_bot"
+# сообщение в Telegram не длиннее 4096 символов
+METRICS_SUMMARY_LIMIT = 4000
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        # верхняя граница корзины, в которую попадает квантиль
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def flatten_stats(stats, labels=()):
+    # вложенные словари и списки из stats() превращаются в метки
+    for name, value in stats.items():
+        if isinstance(value, bool):
+            yield name, labels, int(value)
+        elif isinstance(value, (int, float)):
+            yield name, labels, value
+        elif isinstance(value, dict):
+            for key, item in value.items():
+                yield from flatten_stats({name: item}, labels + (("key", key),))
+        elif isinstance(value, (list, tuple)):
+            for index, item in enumerate(value):
+                yield from flatten_stats({name: item}, labels + (("index", index),))
+
+
+class Metrics:
+    # Гистограммы времени по этапам обработки (routing, is_valid, business_logic,
+    # change_user_state, telegram_api) с метками диалога и состояния, плюс
+    # счётчики stats() кэшей, пулов и очередей
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self._histograms = {}
+        self._collectors = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = Histogram(self.buckets)
+                self._histograms[key] = histogram
+            histogram.observe(value)
+
+    @contextmanager
+    def timed(self, name, **labels):
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started_at, **labels)
+
+    def register_collector(self, name, collect):
+        self._collectors[name] = collect
+
+    def collect(self):
+        for name, collect in list(self._collectors.items()):
+            try:
+                yield name, collect()
+            except Exception as e:
+                logger.error(f"Ошибка сбора метрик {name}: {e}")
+
+    def render(self):
+        lines = []
+        with self._lock:
+            histograms = sorted(
+                (key, list(histogram.counts), histogram.count, histogram.sum)
+                for key, histogram in self._histograms.items()
+            )
+        described = set()
+        for (name, labels), counts, count, total in histograms:
+            metric = f"{METRICS_PREFIX}_{name}_seconds"
+            if metric not in described:
+                described.add(metric)
+                lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{metric}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{metric}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{metric}_sum{format_labels(labels)} {total}")
+            lines.append(f"{metric}_count{format_labels(labels)} {count}")
+        for collector, stats in self.collect():
+            for name, labels, value in flatten_stats(stats):
+                metric = f"{METRICS_PREFIX}_{collector}_{name}"
+                if metric not in described:
+                    described.add(metric)
+                    lines.append(f"# TYPE {metric} gauge")
+                lines.append(f"{metric}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        with self._lock:
+            histograms = [
+                (name, dict(labels), histogram.count, histogram.sum, histogram.quantile(0.95))
+                for (name, labels), histogram in self._histograms.items()
+            ]
+        # сначала этапы, занявшие больше всего времени
+        histograms.sort(key=lambda item: item[3], reverse=True)
+        lines = ["Время обработки (сумма, количество, среднее, p95):"]
+        for name, labels, count, total, p95 in histograms:
+            label_text = "/".join(str(value) for value in labels.values())
+            lines.append(
+                f"{name} {label_text}: {total:.2f} с, {count}, "
+                f"{total / count * 1000:.0f} мс, <={p95 * 1000:.0f} мс"
+            )
+        for collector, stats in self.collect():
+            values = ", ".join(f"{name}={value}" for name, value in stats.items())
+            lines.append(f"{collector}: {values}")
+        text = "\n".join(lines)
+        if len(text) > METRICS_SUMMARY_LIMIT:
+            text = text[:METRICS_SUMMARY_LIMIT] + "\n…"
+        return text
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return server
+
+
+metrics = Metrics(METRICS_BUCKETS)
@@ -0,0 +1,168 @@
+import json
+
+from loguru import logger
+from sqlalchemy import inspect
+from sqlalchemy.sql import text
+
+from database import engine, serialize_json
+from models import (Base, Broadcast, FunnelCounter, Notification,
+                    TransitionEvent)
+
+
+def add_column(connection, table, column, definition):
+    columns = [column["name"] for column in inspect(connection).get_columns(table)]
+    if column not in columns:
+        connection.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {column} {definition}'))
+
+
+def create_tables(connection):
+    Base.metadata.create_all(connection)
+
+
+def add_username(connection):
+    add_column(connection, "user", "username", "VARCHAR(255)")
+
+
+def add_previous_state(connection):
+    add_column(connection, "user", "previous_state", "VARCHAR(255)")
+
+
+def add_indexes(connection):
+    # запросы брали первую запись пользователя, её и оставляем
+    connection.execute(
+        text('DELETE FROM "user" WHERE id NOT IN (SELECT MIN(id) FROM "user" GROUP BY user_id)')
+    )
+    connection.execute(
+        text('CREATE UNIQUE INDEX IF NOT EXISTS ix_user_user_id ON "user" (user_id)')
+    )
+    connection.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_appointment_date ON appointment (date)")
+    )
+    connection.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_service_age_category ON service (age_category)")
+    )
+
+
+def split_state(value):
+    # старый формат: "диалог__состояние__{json контекста}"
+    if value is None:
+        return None, None, None
+    state_arguments = value.split("__", 2)
+    dialog = state_arguments[0]
+    state = state_arguments[1] if len(state_arguments) > 1 else ""
+    context = json.loads(state_arguments[2]) if len(state_arguments) > 2 else {}
+    return dialog, state, context
+
+
+def split_state_columns(connection):
+    add_column(connection, "user", "dialog", "VARCHAR(255)")
+    add_column(connection, "user", "context", "JSON")
+    add_column(connection, "user", "previous_dialog", "VARCHAR(255)")
+    rows = connection.execute(
+        text('SELECT id, state, previous_state FROM "user" WHERE dialog IS NULL')
+    ).fetchall()
+    for row_id, state_value, previous_value in rows:
+        try:
+            dialog, state, context = split_state(state_value)
+        except ValueError:
+            # контекст мог быть обрезан по "__" из текста пользователя
+            dialog, state, context = split_state(state_value.split("__{", 1)[0])
+        previous_dialog, previous_state, _ = split_state(
+            previous_value.split("__{", 1)[0] if previous_value else None
+        )
+        connection.execute(
+            text(
+                'UPDATE "user" SET dialog = :dialog, state = :state, context = :context, '
+                "previous_dialog = :previous_dialog, previous_state = :previous_state "
+                "WHERE id = :id"
+            ),
+            {
+                "id": row_id,
+                "dialog": dialog,
+                "state": state,
+                "context": serialize_json(context),
+                "previous_dialog": previous_dialog,
+                "previous_state": previous_state,
+            },
+        )
+
+
+def create_notifications(connection):
+    Notification.__table__.create(connection, checkfirst=True)
+
+
+def fill_funnel_counters(connection):
+    FunnelCounter.__table__.create(connection, checkfirst=True)
+    connection.execute(text("DELETE FROM funnel_counter"))
+    connection.execute(
+        text(
+            "INSERT INTO funnel_counter (dialog, state, users) "
+            'SELECT previous_dialog, previous_state, COUNT(*) FROM "user" '
+            "WHERE previous_dialog IS NOT NULL AND previous_state IS NOT NULL "
+            "GROUP BY previous_dialog, previous_state"
+        )
+    )
+
+
+def create_transition_events(connection):
+    TransitionEvent.__table__.create(connection, checkfirst=True)
+
+
+def add_broadcasts(connection):
+    add_column(connection, "user", "is_blocked", "BOOLEAN NOT NULL DEFAULT FALSE")
+    Broadcast.__table__.create(connection, checkfirst=True)
+
+
+def add_appointment_date_id_index(connection):
+    connection.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_appointment_date_id ON appointment (date, id)")
+    )
+
+
+# Миграции должны быть идемпотентными: новая база создаётся create_tables по текущим моделям
+MIGRATIONS = [
+    (1, "Создание таблиц", create_tables),
+    (2, "Поле user.username", add_username),
+    (3, "Поле user.previous_state", add_previous_state),
+    (4, "Индексы по user.user_id, appointment.date, service.age_category", add_indexes),
+    (5, "Раздельные поля диалога, состояния и контекста", split_state_columns),
+    (6, "Очередь уведомлений администраторам", create_notifications),
+    (7, "Счётчики воронки пользователей", fill_funnel_counters),
+    (8, "Журнал переходов между состояниями", create_transition_events),
+    (9, "Рассылки и поле user.is_blocked", add_broadcasts),
+    (10, "Индекс для постраничного просмотра заявок", add_appointment_date_id_index),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(connection):
+    connection.execute(
+        text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    )
+    return connection.execute(text("SELECT MAX(version) FROM schema_version")).scalar() or 0
+
+
+def migrate():
+    with engine.begin() as connection:
+        current_version = get_schema_version(connection)
+    if current_version >= LATEST_VERSION:
+        return current_version
+    for version, description, migration in MIGRATIONS:
+        if version <= current_version:
+            continue
+        with engine.begin() as connection:
+            migration(connection)
+            connection.execute(
+                text("INSERT INTO schema_version (version) VALUES (:version)"),
+                {"version": version},
+            )
+        logger.info(f"Применена миграция {version}: {description}")
+    return LATEST_VERSION
+
+
+if __name__ == "__main__":
+    try:
+        version = migrate()
+        logger.success(f"База данных обновлена до версии {version}")
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении базы данных {e}")
@@ -1,14 +1,26 @@
 import enum
+import threading
+import time
+from collections import Counter, namedtuple
 
 from loguru import logger
-from sqlalchemy import (Boolean, Column, Date, Enum, ForeignKey, Integer,
-                        String, create_engine)
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker
+from sqlalchemy import (JSON, Boolean, Column, Date, DateTime, Enum,
+                        ForeignKey, Index, Integer, String, bindparam, false,
+                        select, tuple_, update)
+from sqlalchemy.orm import declarative_base, relationship
 
-from config import BASE_NAME, ADMINS
+from config import ADMINS
+from events import transition_log
+from database import (Session, engine, get_async_session, get_upsert,
+                      on_commit, session_scope)
+from state_cache import STATE_CACHE_WRITE_BEHIND, state_cache
 
 Base = declarative_base()
-engine = create_engine(BASE_NAME, echo=True)
+
+UserState = namedtuple(
+    "UserState",
+    ["dialog", "state", "context", "previous_dialog", "previous_state", "username"],
+)
 
 
 class AgeCategories(enum.Enum):
@@ -20,7 +32,7 @@ class AgeCategories(enum.Enum):
 class Service(Base):
     __tablename__ = "service"
     id = Column(Integer, primary_key=True)
-    age_category = Column(Enum(AgeCategories), nullable=False)
+    age_category = Column(Enum(AgeCategories), nullable=False, index=True)
     name = Column(String, nullable=False)
     description = Column(String, nullable=False)
     is_link = Column(Boolean, default=False, nullable=False)
@@ -38,43 +50,248 @@ class Appointment(Base):
     request = Column(String, nullable=False)
     phone_number = Column(String, nullable=False)
     username = Column(String, nullable=True)
-    date = Column(Date, nullable=False)
+    date = Column(Date, nullable=False, index=True)
 
     service = relationship("Service", back_populates="appointments")
 
+    # порядок просмотра заявок администратором: новые сверху
+    __table_args__ = (Index("ix_appointment_date_id", "date", "id"),)
+
+    @staticmethod
+    def get_page(session, limit, after=None, before=None):
+        # Постраничный просмотр по ключу (date, id) вместо OFFSET: любая
+        # страница читается по индексу за одинаковое время. after - ключ
+        # последней заявки текущей страницы (листаем к более старым),
+        # before - ключ первой (листаем к более новым). Возвращает заявки
+        # от новых к старым и признак, что в направлении листания есть ещё.
+        key = tuple_(Appointment.date, Appointment.id)
+        query = select(
+            Appointment.id,
+            Appointment.date,
+            Appointment.client_name,
+            Appointment.username,
+            Appointment.phone_number,
+            Appointment.problem_description,
+            Appointment.request,
+            Service.name.label("service_name"),
+        ).outerjoin(Appointment.service)
+        if before is not None:
+            query = query.where(key > tuple_(*before)).order_by(
+                Appointment.date, Appointment.id
+            )
+        else:
+            if after is not None:
+                query = query.where(key < tuple_(*after))
+            query = query.order_by(Appointment.date.desc(), Appointment.id.desc())
+        rows = session.execute(query.limit(limit + 1)).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if before is not None:
+            rows.reverse()
+        return rows, has_more
+
+
+class Notification(Base):
+    # неотправленные уведомления администраторам, доставленные удаляются
+    __tablename__ = "notification"
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer, nullable=False)
+    text = Column(String, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(DateTime, nullable=False, index=True)
+
+
+class TransitionEvent(Base):
+    # журнал переходов между состояниями для анализа воронки,
+    # latency_ms - время обработки обновления до фиксации
+    __tablename__ = "transition_event"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False, index=True)
+    from_dialog = Column(String)
+    from_state = Column(String)
+    to_dialog = Column(String, nullable=False)
+    to_state = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False, index=True)
+    latency_ms = Column(Integer)
+
+    @staticmethod
+    def write_events(events):
+        with engine.begin() as connection:
+            connection.execute(TransitionEvent.__table__.insert(), events)
+
+
+class FunnelCounter(Base):
+    # число пользователей по последнему показанному экрану
+    # (previous_dialog, previous_state), поддерживается в User.set_state
+    __tablename__ = "funnel_counter"
+    dialog = Column(String, primary_key=True)
+    state = Column(String, primary_key=True)
+    users = Column(Integer, default=0, nullable=False)
+
+    @staticmethod
+    def get_deltas(current, new_state):
+        deltas = Counter()
+        old_key = (current.previous_dialog, current.previous_state)
+        new_key = (new_state.previous_dialog, new_state.previous_state)
+        if old_key != new_key:
+            if None not in old_key:
+                deltas[old_key] -= 1
+            if None not in new_key:
+                deltas[new_key] += 1
+        return deltas
+
+    @staticmethod
+    def apply(connection, deltas):
+        rows = [
+            {"dialog": dialog, "state": state, "users": delta}
+            for (dialog, state), delta in deltas.items()
+            if delta
+        ]
+        if not rows:
+            return
+        table = FunnelCounter.__table__
+        statement = get_upsert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.dialog, table.c.state],
+            set_={"users": table.c.users + statement.excluded.users},
+        )
+        connection.execute(statement, rows)
+
+    @staticmethod
+    def get_counts(session=None):
+        with session_scope(session) as session:
+            return {
+                (dialog, state): users
+                for dialog, state, users in session.execute(
+                    select(FunnelCounter.dialog, FunnelCounter.state, FunnelCounter.users)
+                )
+            }
+
+
+class FunnelDeltas:
+    # изменения счётчиков в режиме write-behind, пишутся вместе с состояниями
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = Counter()
+
+    def add(self, deltas):
+        with self._lock:
+            for key, delta in deltas.items():
+                self._pending[key] += delta
+
+    def take(self):
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+        return pending
+
+    def restore(self, deltas):
+        self.add(deltas)
+
+
+funnel_deltas = FunnelDeltas()
+
+
+class Broadcast(Base):
+    # рассылка всем пользователям; last_user_id - позиция по User.id,
+    # с которой рассылка продолжится после перезапуска
+    __tablename__ = "broadcast"
+    id = Column(Integer, primary_key=True)
+    admin_id = Column(Integer, nullable=False)
+    text = Column(String, nullable=False)
+    buttons = Column(JSON)
+    screen = Column(String)
+    status = Column(String, nullable=False, default="running", index=True)
+    last_user_id = Column(Integer, nullable=False, default=0)
+    sent = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    blocked = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, nullable=False)
+    finished_at = Column(DateTime)
+
+    @staticmethod
+    def recipients(screen=None, after_user_id=0):
+        query = select(User.id, User.user_id).where(
+            User.is_blocked.is_(False), User.id > after_user_id
+        )
+        if screen is not None:
+            query = query.where(
+                User.previous_dialog == "user_services", User.previous_state == screen
+            )
+        return query.order_by(User.id)
+
 
 class User(Base):
     __tablename__ = "user"
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, nullable=False)
+    user_id = Column(Integer, nullable=False, unique=True, index=True)
+    dialog = Column(String)
     state = Column(String, nullable=False)
+    context = Column(JSON)
+    previous_dialog = Column(String)
     previous_state = Column(String)
-    username = Column(String, nullable=False)
+    username = Column(String)
+    # бот заблокирован пользователем, рассылки его пропускают
+    is_blocked = Column(Boolean, default=False, server_default=false(), nullable=False)
 
     @staticmethod
-    def create_user(user_id):
-        engine = create_engine(BASE_NAME, echo=True)
-        Session = sessionmaker(bind=engine)
-        session = Session()
-
-        user = session.query(User).filter_by(user_id=user_id).first()
-        if user_id in ADMINS:
-            initial_state = "admin_services__my_services"
-        else:
-            initial_state = "user_services__menu"
-        if user:
-            user.state = initial_state
-        else:
-            user = User(user_id=user_id, state=initial_state)
-            session.add(user)
-        session.commit()
-        session.close()
+    def state_columns():
+        return [getattr(User, field) for field in UserState._fields]
+
+    @staticmethod
+    def create_user(user_id, username=None, session=None):
+        with session_scope(session) as session:
+            user = session.query(User).filter_by(user_id=user_id).first()
+            if user_id in ADMINS:
+                initial_dialog, initial_state = "admin_services", "my_services"
+            else:
+                initial_dialog, initial_state = "user_services", "menu"
+            if user and STATE_CACHE_WRITE_BEHIND:
+                user.is_blocked = False
+                # Незаписанное состояние из кэша нельзя выбрасывать: изменения
+                # счётчиков воронки по нему уже учтены в funnel_deltas.
+                # Сбрасываем состояние через кэш, previous_* не меняются.
+                current = User.get_cached_state(session, user_id)
+                if current is None:
+                    current = User.load_state(session, user_id)
+                new_state = current._replace(
+                    dialog=initial_dialog,
+                    state=initial_state,
+                    context={},
+                    username=username,
+                )
+                session.info.setdefault("user_states", {})[user_id] = new_state
+                on_commit(session, lambda: state_cache.put(user_id, new_state, dirty=True))
+                return
+            if user:
+                user.dialog = initial_dialog
+                user.state = initial_state
+                user.context = {}
+                user.username = username
+                user.is_blocked = False
+            else:
+                user = User(
+                    user_id=user_id,
+                    dialog=initial_dialog,
+                    state=initial_state,
+                    context={},
+                    username=username,
+                )
+                session.add(user)
+            # в той же единице работы следующий get_state/set_state должен
+            # видеть сброшенное состояние, а не кэш
+            session.info.setdefault("user_states", {})[user_id] = UserState(
+                dialog=initial_dialog,
+                state=initial_state,
+                context={},
+                previous_dialog=user.previous_dialog,
+                previous_state=user.previous_state,
+                username=username,
+            )
+            on_commit(session, lambda: state_cache.invalidate(user_id))
 
     @staticmethod
     def get_or_create_user(user_id):
         try:
-            engine = create_engine(BASE_NAME, echo=True)
-            Session = sessionmaker(bind=engine)
             session = Session()
 
             user = session.query(User).filter_by(user_id=user_id).first()
@@ -90,33 +307,133 @@ class User(Base):
             logger.error(e)
 
     @staticmethod
-    def get_state(user_id):
+    def load_state(session, user_id):
+        row = session.execute(
+            select(*User.state_columns()).where(User.user_id == user_id)
+        ).first()
+        if row is None:
+            return None
+        user_state = UserState(*row)
+        state_cache.put(user_id, user_state)
+        return user_state
+
+    @staticmethod
+    def get_cached_state(session, user_id):
+        # состояние, изменённое в ещё не зафиксированной транзакции, важнее кэша
+        pending = session.info.get("user_states", {}) if session is not None else {}
+        if user_id in pending:
+            return pending[user_id]
+        return state_cache.get(user_id)
+
+    @staticmethod
+    def get_state(user_id, session=None):
         try:
-            engine = create_engine(BASE_NAME, echo=True)
-            Session = sessionmaker(bind=engine)
-            session = Session()
+            user_state = User.get_cached_state(session, user_id)
+            if user_state is None:
+                with session_scope(session) as session:
+                    user_state = User.load_state(session, user_id)
+            return user_state
+        except Exception as e:
+            logger.error(e)
 
-            user = session.query(User).filter_by(user_id=user_id).first()
-            session.close()
-            return user.state
+    @staticmethod
+    async def get_state_async(user_id, session=None):
+        try:
+            user_state = User.get_cached_state(session, user_id)
+            if user_state is None:
+                async with get_async_session() as async_session:
+                    row = (
+                        await async_session.execute(
+                            select(*User.state_columns()).where(User.user_id == user_id)
+                        )
+                    ).first()
+                if row is not None:
+                    user_state = UserState(*row)
+                    state_cache.put(user_id, user_state)
+            return user_state
         except Exception as e:
             logger.error(e)
 
     @staticmethod
-    def set_state(user_id, state, username):
+    def set_state(user_id, dialog, state, username, context=None, session=None):
         try:
-            engine = create_engine(BASE_NAME, echo=True)
-            Session = sessionmaker(bind=engine)
-            session = Session()
+            with session_scope(session) as session:
+                current = User.get_cached_state(session, user_id)
+                if current is None:
+                    current = User.load_state(session, user_id)
+                if current is None:
+                    raise Exception(f"Пользователь {user_id} не найден")
+                new_state = UserState(
+                    dialog=dialog,
+                    state=state,
+                    context=dict(context or {}),
+                    previous_dialog=current.dialog,
+                    previous_state=current.state,
+                    username=username,
+                )
+                session.info.setdefault("user_states", {})[user_id] = new_state
+                deltas = FunnelCounter.get_deltas(current, new_state)
+                started_at = session.info.get("started_at")
+                on_commit(
+                    session,
+                    lambda: transition_log.record(
+                        user_id,
+                        current,
+                        new_state,
+                        None if started_at is None else time.monotonic() - started_at,
+                    ),
+                )
 
-            user = session.query(User).filter_by(user_id=user_id).first()
-            user.previous_state = user.state
-            user.state = state
-            user.username = username
-            session.commit()
+                if STATE_CACHE_WRITE_BEHIND:
+                    def write_behind():
+                        state_cache.put(user_id, new_state, dirty=True)
+                        funnel_deltas.add(deltas)
+
+                    on_commit(session, write_behind)
+                    return
+                # записываем только изменившиеся поля
+                changes = {
+                    field: value
+                    for field, value in new_state._asdict().items()
+                    if value != getattr(current, field)
+                }
+                if changes:
+                    session.execute(
+                        update(User)
+                        .where(User.user_id == user_id)
+                        .values(**changes)
+                        .execution_options(synchronize_session=False)
+                    )
+                FunnelCounter.apply(session, deltas)
+                on_commit(session, lambda: state_cache.put(user_id, new_state))
         except Exception as e:
             logger.error(e)
 
+    @staticmethod
+    def write_states(states):
+        table = User.__table__
+        statement = (
+            update(table)
+            .where(table.c.user_id == bindparam("b_user_id"))
+            .values(
+                {field: bindparam(f"b_{field}") for field in UserState._fields}
+            )
+        )
+        deltas = funnel_deltas.take()
+        try:
+            with engine.begin() as connection:
+                connection.execute(
+                    statement,
+                    [
+                        {"b_user_id": user_id}
+                        | {f"b_{field}": value for field, value in user_state._asdict().items()}
+                        for user_id, user_state in states.items()
+                    ],
+                )
+                FunnelCounter.apply(connection, deltas)
+        except Exception:
+            funnel_deltas.restore(deltas)
+            raise
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,177 @@
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta
+
+from loguru import logger
+from sqlalchemy import delete, select, update
+
+import config
+from config import ADMINS
+from database import Session, on_commit, session_scope
+from dispatcher import NOTIFICATION, is_retryable
+from models import Notification
+
+NOTIFICATION_BATCH_SIZE = getattr(config, "NOTIFICATION_BATCH_SIZE", 50)
+NOTIFICATION_POLL_INTERVAL = getattr(config, "NOTIFICATION_POLL_INTERVAL", 30)
+NOTIFICATION_SEND_TIMEOUT = getattr(config, "NOTIFICATION_SEND_TIMEOUT", 120)
+NOTIFICATION_MAX_BACKOFF = getattr(config, "NOTIFICATION_MAX_BACKOFF", 3600)
+NOTIFICATION_MAX_ATTEMPTS = getattr(config, "NOTIFICATION_MAX_ATTEMPTS", 20)
+
+# выставляется после фиксации транзакции с новыми уведомлениями
+notifications_ready = threading.Event()
+
+
+def notify_admins(session, text):
+    # уведомления сохраняются в той же транзакции, что и заявка, поэтому
+    # не теряются при перезапуске и не задерживают ответ клиенту
+    now = datetime.now()
+    session.add_all(
+        [
+            Notification(chat_id=admin, text=text, attempts=0, next_attempt_at=now)
+            for admin in ADMINS
+        ]
+    )
+    on_commit(session, notifications_ready.set)
+
+
+def get_backoff(attempts):
+    return min(10 * 2 ** (attempts - 1), NOTIFICATION_MAX_BACKOFF)
+
+
+class NotificationSender:
+    # Фоновый поток отправляет накопившиеся уведомления через OutboundDispatcher
+    # и удаляет доставленные; неудачные откладываются с растущей задержкой
+    def __init__(
+        self,
+        bot,
+        batch_size=NOTIFICATION_BATCH_SIZE,
+        poll_interval=NOTIFICATION_POLL_INTERVAL,
+        send_timeout=NOTIFICATION_SEND_TIMEOUT,
+        max_attempts=NOTIFICATION_MAX_ATTEMPTS,
+    ):
+        self.bot = bot
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.send_timeout = send_timeout
+        self.max_attempts = max_attempts
+        self.thread = None
+        self._stopping = False
+        # уведомления, не отправленные за send_timeout: они остаются в очереди
+        # отправителя, повторная постановка прислала бы администратору дубль
+        self._waiting = {}
+        self.delivered = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="notifications", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=10):
+        self._stopping = True
+        notifications_ready.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def _run(self):
+        while not self._stopping:
+            notifications_ready.clear()
+            try:
+                count = self.deliver_due()
+            except Exception as e:
+                logger.error(e)
+                count = 0
+            if count < self.batch_size:
+                notifications_ready.wait(self.poll_interval)
+
+    def deliver_due(self):
+        query = (
+            select(Notification.id, Notification.chat_id, Notification.text, Notification.attempts)
+            .where(Notification.next_attempt_at <= datetime.now())
+            .order_by(Notification.next_attempt_at, Notification.id)
+            .limit(self.batch_size)
+        )
+        if self._waiting:
+            query = query.where(Notification.id.not_in(list(self._waiting)))
+        session = Session()
+        try:
+            due = session.execute(query).all()
+        finally:
+            session.close()
+
+        # результаты дождавшихся отправки разбираем вместе с новыми
+        sending = [
+            self._waiting.pop(notification_id)
+            for notification_id, (_, future) in list(self._waiting.items())
+            if future.done()
+        ]
+        if not due and not sending:
+            return 0
+
+        # сначала ставим в очередь все уведомления, потом ждём результаты
+        sending += [
+            (
+                notification,
+                self.bot.send_message(
+                    notification.chat_id,
+                    notification.text,
+                    parse_mode="HTML",
+                    priority=NOTIFICATION,
+                ),
+            )
+            for notification in due
+        ]
+        delivered = []
+        failed = []
+        dropped = []
+        deadline = time.monotonic() + self.send_timeout
+        for notification, future in sending:
+            try:
+                future.result(timeout=max(0, deadline - time.monotonic()))
+                delivered.append(notification.id)
+            except FutureTimeoutError:
+                # это не неудачная попытка: сообщение ещё ждёт в очереди,
+                # результат разберём в следующем проходе
+                logger.warning(f"Уведомление {notification.id} для {notification.chat_id} ещё не отправлено")
+                self._waiting[notification.id] = (notification, future)
+                future.add_done_callback(lambda future: notifications_ready.set())
+            except Exception as e:
+                if is_retryable(e):
+                    logger.warning(f"Уведомление {notification.id} для {notification.chat_id} не доставлено: {e}")
+                    failed.append(notification)
+                else:
+                    logger.error(f"Уведомление {notification.id} для {notification.chat_id} отброшено: {e}")
+                    dropped.append(notification.id)
+
+        now = datetime.now()
+        with session_scope() as session:
+            for notification in failed:
+                attempts = notification.attempts + 1
+                if attempts >= self.max_attempts:
+                    logger.error(f"Уведомление {notification.id} для {notification.chat_id} отброшено после {attempts} попыток")
+                    dropped.append(notification.id)
+                    continue
+                session.execute(
+                    update(Notification)
+                    .where(Notification.id == notification.id)
+                    .values(
+                        attempts=attempts,
+                        next_attempt_at=now + timedelta(seconds=get_backoff(attempts)),
+                    )
+                )
+            if delivered or dropped:
+                session.execute(
+                    delete(Notification).where(Notification.id.in_(delivered + dropped))
+                )
+        self.delivered += len(delivered)
+        self.failed += len(failed)
+        self.dropped += len(dropped)
+        return len(due)
+
+    def stats(self):
+        return {
+            "delivered": self.delivered,
+            "failed": self.failed,
+            "dropped": self.dropped,
+        }
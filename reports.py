@@ -0,0 +1,164 @@
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from loguru import logger
+
+import config
+from database import Session
+from dispatcher import NOTIFICATION
+from logging_config import setup_logging
+
+# 0 - строить отчёты в потоке обработчика, как раньше
+REPORT_WORKERS = getattr(config, "REPORT_WORKERS", 2)
+
+
+# exporters тянет openpyxl, поэтому загружается только при построении отчёта
+def build_appointments(session, file, since_date, until_date):
+    from exporters import export_appointments
+
+    return export_appointments(
+        session,
+        datetime.strptime(since_date, "%d.%m.%Y"),
+        datetime.strptime(until_date, "%d.%m.%Y"),
+        file=file,
+    )
+
+
+def build_user_statistics(session, file):
+    from exporters import export_user_statistics
+
+    return export_user_statistics(session, file=file)
+
+
+REPORTS = {
+    "appointments": build_appointments,
+    "user_statistics": build_user_statistics,
+}
+
+
+def build_report(report, params):
+    # выполняется в дочернем процессе, результат передаётся через файл на диске
+    file = tempfile.NamedTemporaryFile(prefix="report-", delete=False)
+    try:
+        with Session() as session:
+            _, name = REPORTS[report](session, file, *params)
+    except Exception:
+        file.close()
+        os.remove(file.name)
+        raise
+    file.close()
+    return file.name, name
+
+
+class ReportJobs:
+    # Отчёты строятся в пуле процессов и не занимают потоки обработки
+    # обновлений. Одинаковые запросы (отчёт и параметры) объединяются в одну
+    # задачу, документ получают все, кто его запросил.
+    def __init__(self, workers=REPORT_WORKERS):
+        self.workers = workers
+        self.bot = None
+        self.executor = None
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self.submitted = 0
+        self.deduplicated = 0
+        self.failed = 0
+
+    def start(self, bot):
+        self.bot = bot
+        if self.workers:
+            # spawn: дочерний процесс не наследует потоки и соединения с базой
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=setup_logging,
+            )
+
+    def stop(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, chat_id, report, params=()):
+        key = (report, tuple(params))
+        with self._lock:
+            waiting = self._jobs.get(key)
+            if waiting is not None:
+                waiting.add(chat_id)
+                self.deduplicated += 1
+                return False
+            self._jobs[key] = {chat_id}
+            self.submitted += 1
+        if self.executor is None:
+            try:
+                result = build_report(report, key[1])
+            except Exception as e:
+                self._fail(key, e)
+            else:
+                self._deliver(key, result)
+            return True
+        try:
+            future = self.executor.submit(build_report, report, key[1])
+        except Exception as e:
+            self._fail(key, e)
+            return True
+        future.add_done_callback(lambda done: self._finish(key, done))
+        return True
+
+    def _finish(self, key, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            self._fail(key, e)
+        else:
+            self._deliver(key, result)
+
+    def _fail(self, key, error):
+        logger.error(f"Ошибка создания отчёта {key[0]}: {error}")
+        with self._lock:
+            chat_ids = self._jobs.pop(key, set())
+            self.failed += 1
+        for chat_id in chat_ids:
+            self.bot.send_message(chat_id, "Ошибка создания документа", priority=NOTIFICATION)
+
+    def _deliver(self, key, result):
+        path, name = result
+        with self._lock:
+            chat_ids = self._jobs.pop(key, set())
+        if not chat_ids:
+            os.remove(path)
+            return
+        remaining = [len(chat_ids)]
+
+        def sent(document):
+            document.close()
+            with self._lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            os.remove(path)
+
+        for chat_id in chat_ids:
+            document = open(path, "rb")
+            future = self.bot.send_document(
+                chat_id, document=document, visible_file_name=name, priority=NOTIFICATION
+            )
+            if future is None:
+                sent(document)
+            else:
+                future.add_done_callback(lambda done, document=document: sent(document))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "running": len(self._jobs),
+                "submitted": self.submitted,
+                "deduplicated": self.deduplicated,
+                "failed": self.failed,
+            }
+
+
+report_jobs = ReportJobs()
@@ -0,0 +1,44 @@
+import time
+
+from admin_services import AdminServices
+from database import UnitOfWork
+from metrics import metrics
+from models import User
+from user_services import UserServices
+
+# обработка обновлений, общая для main.py и async_main.py
+dialog_classes_router = {
+    "admin_services": AdminServices,
+    "user_services": UserServices,
+}
+
+
+def process_update(bot, user, users_message=None, callback=None, reset_state=None, start=False):
+    started_at = time.monotonic()
+    labels = {"dialog": "", "state": ""}
+    try:
+        with UnitOfWork() as uow:
+            if start:
+                # /start: создание или сброс пользователя в той же транзакции
+                User.create_user(user.id, user.username, session=uow.session)
+            if reset_state is not None:
+                dialog_name, state = reset_state
+                User.set_state(user.id, dialog_name, state, user.username, session=uow.session)
+            user_state = User.get_state(user.id, session=uow.session)
+            labels = {"dialog": user_state.dialog, "state": user_state.state}
+
+            dialog_class = dialog_classes_router[user_state.dialog]
+            dialog_class(
+                bot=bot,
+                user=user,
+                dialog_name=user_state.dialog,
+                state=user_state.state,
+                # обработчики дополняют контекст на месте, кэш менять нельзя
+                context=dict(user_state.context or {}),
+                users_message=users_message,
+                callback=callback,
+                uow=uow,
+            ).process_message()
+    finally:
+        # время включает фиксацию транзакции
+        metrics.observe("routing", time.monotonic() - started_at, **labels)
@@ -0,0 +1,56 @@
+from broadcasts import BroadcastSender
+from dialog_classes import keyboard_cache
+from events import (TRANSITION_LOG_ENABLED, TRANSITION_LOG_FLUSH_INTERVAL,
+                    start_transition_log, transition_log)
+from logging_config import setup_logging
+from metrics import METRICS_ENABLED, metrics, start_metrics_server
+from migrations import migrate
+from models import TransitionEvent, User
+from notifications import NotificationSender
+from reports import report_jobs
+from state_cache import (STATE_CACHE_FLUSH_INTERVAL, STATE_CACHE_WRITE_BEHIND,
+                         start_write_behind, state_cache)
+
+
+class BackgroundServices:
+    # Фоновые службы, общие для main.py и async_main.py. Отправитель
+    # (OutboundDispatcher или AsyncOutboundDispatcher) запускает и
+    # останавливает сама точка входа: у асинхронного это задачи цикла событий.
+    def __init__(self, outbound, worker_pool=None):
+        self.outbound = outbound
+        self.worker_pool = worker_pool
+        self.notification_sender = NotificationSender(outbound)
+        self.broadcast_sender = BroadcastSender(outbound)
+
+    def start(self):
+        setup_logging()
+        migrate()
+        if STATE_CACHE_WRITE_BEHIND:
+            start_write_behind(state_cache, User.write_states, STATE_CACHE_FLUSH_INTERVAL)
+        if TRANSITION_LOG_ENABLED:
+            start_transition_log(
+                transition_log, TransitionEvent.write_events, TRANSITION_LOG_FLUSH_INTERVAL
+            )
+        if METRICS_ENABLED:
+            metrics.register_collector("state_cache", state_cache.stats)
+            metrics.register_collector("keyboard_cache", keyboard_cache.stats)
+            metrics.register_collector("outbound", self.outbound.stats)
+            metrics.register_collector("notifications", self.notification_sender.stats)
+            metrics.register_collector("broadcasts", self.broadcast_sender.stats)
+            metrics.register_collector("reports", report_jobs.stats)
+            metrics.register_collector("transition_log", transition_log.stats)
+            if self.worker_pool is not None:
+                metrics.register_collector("worker_pool", self.worker_pool.stats)
+            start_metrics_server()
+        self.notification_sender.start()
+        self.broadcast_sender.start()
+        report_jobs.start(self.outbound)
+        if self.worker_pool is not None:
+            self.worker_pool.start()
+
+    def stop(self):
+        if self.worker_pool is not None:
+            self.worker_pool.stop()
+        report_jobs.stop()
+        self.broadcast_sender.stop()
+        self.notification_sender.stop()
@@ -0,0 +1,109 @@
+import atexit
+import threading
+import time
+from collections import OrderedDict
+
+from loguru import logger
+
+import config
+
+STATE_CACHE_SIZE = getattr(config, "STATE_CACHE_SIZE", 10000)
+STATE_CACHE_TTL = getattr(config, "STATE_CACHE_TTL", 3600)
+# False - запись сразу в базу (write-through), True - пакетная запись в фоне (write-behind)
+STATE_CACHE_WRITE_BEHIND = getattr(config, "STATE_CACHE_WRITE_BEHIND", False)
+STATE_CACHE_FLUSH_INTERVAL = getattr(config, "STATE_CACHE_FLUSH_INTERVAL", 1.0)
+
+
+class StateCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        # незаписанные в базу значения не вытесняются и не устаревают до сброса
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.flushes = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._dirty:
+                self.hits += 1
+                return self._dirty[key]
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, dirty=False):
+        with self._lock:
+            if dirty:
+                self._dirty[key] = value
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._dirty.pop(key, None)
+
+    def flush(self, write):
+        with self._lock:
+            pending = dict(self._dirty)
+        if not pending:
+            return
+        write(pending)
+        with self._lock:
+            for key, value in pending.items():
+                # значение могло измениться, пока шла запись
+                if self._dirty.get(key) is value:
+                    del self._dirty[key]
+            self.flushes += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "dirty": len(self._dirty),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "flushes": self.flushes,
+            }
+
+
+def start_write_behind(cache, write, interval):
+    def flush():
+        try:
+            cache.flush(write)
+        except Exception as e:
+            logger.error(f"Ошибка записи состояний пользователей: {e}")
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            flush()
+
+    thread = threading.Thread(target=loop, name="state-cache-flush", daemon=True)
+    thread.start()
+    atexit.register(flush)
+    return thread
+
+
+state_cache = StateCache(STATE_CACHE_SIZE, STATE_CACHE_TTL)
@@ -1,19 +1,14 @@
 import re
 from datetime import datetime
+from html import escape
 
 from loguru import logger
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 
-from config import ADMINS, BASE_NAME, LOGFILE
+from catalog import catalog
 from dialog_classes import (DialogClass, StateProcessorClass,
                             ValidationException)
-from models import AgeCategories, Appointment, Service
-
-logger.add(LOGFILE, format="{time} {level} {message}", level="ERROR", rotation="400KB", compression="zip")
-
-engine = create_engine(BASE_NAME, echo=True)
-Session = sessionmaker(bind=engine)
+from models import AgeCategories, Appointment
+from notifications import notify_admins
 
 
 class Menu(StateProcessorClass):
@@ -66,10 +61,12 @@ class SelectService(StateProcessorClass):
         else:
             return False
 
+    def get_keyboard_cache_key(self):
+        return ("select_service", self.callback, catalog.version)
+
     def get_inline_buttons(self):
-        session = Session()
         try:
-            services = session.query(Service).filter_by(age_category=self.callback)
+            services = catalog.get_by_age_category(self.callback)
             inline_buttons = {}
             for service in services:
                 inline_buttons[service.id] = service.name
@@ -79,8 +76,6 @@ class SelectService(StateProcessorClass):
             self.text_message = "Ошибка!"
             self.redirect_class = Menu
             return None
-        finally:
-            session.close()
 
 
 class ShowService(StateProcessorClass):
@@ -96,19 +91,16 @@ class ShowService(StateProcessorClass):
         return False
 
     def business_logic(self):
-
-        session = Session()
         try:
             service_id = self.callback
-            self.service = session.query(Service).get(service_id)
+            self.service = catalog.get(service_id)
         except:
             raise ValidationException
-        finally:
-            session.close()
+        if self.service is None:
+            raise ValidationException
 
     def get_message_text(self):
-        text_message = f"<b>{self.service.name}</b>\n<b>Описание:</b>\n{self.service.description}\n<b>Возрастная категория: </b>{self.service.age_category.value}"
-        return text_message
+        return self.service.card
 
     def get_inline_buttons(self):
         if self.service.is_link:
@@ -226,11 +218,9 @@ class Appoint(StateProcessorClass):
             return True
 
     def business_logic(self):
-        message_text = f"<b>Поступила заявка на консультацию</b>\n<b>Имя клиента:</b> {self.context['name']}\n<b>Алиас:</b> @{self.user.username}\n<b>Описание проблемы:</b>\n{self.context['problem']}\n<b>Запрос:</b>\n{self.context['request']}\n<b>Номер телефона:</b>\n{self.context['phone_number']}"
-        self.send_message(user_id=ADMINS[0], message_text=message_text)
+        message_text = f"<b>Поступила заявка на консультацию</b>\n<b>Имя клиента:</b> {escape(self.context['name'])}\n<b>Алиас:</b> @{escape(self.user.username or '')}\n<b>Описание проблемы:</b>\n{escape(self.context['problem'])}\n<b>Запрос:</b>\n{escape(self.context['request'])}\n<b>Номер телефона:</b>\n{escape(self.context['phone_number'])}"
         self.text_message = "Ваша заявка принята, в ближайшее время я с Вами свяжусь"
         try:
-            session = Session()
             new_user = Appointment(
                 service_id=self.context["service_id"],
                 client_name=self.context["name"],
@@ -240,10 +230,12 @@ class Appoint(StateProcessorClass):
                 username=self.user.username,
                 date=datetime.today().date(),
             )
-            session.add(new_user)
-            session.commit()
+            self.session.add(new_user)
+            self.session.flush()
+            notify_admins(self.session, message_text)
         except Exception as e:
             logger.error(e)
+            self.session.rollback()
         finally:
             self.redirect_class = Menu
             self.redirect_next_state = "@menu"
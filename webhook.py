@@ -0,0 +1,119 @@
+import hmac
+import queue
+import ssl
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from loguru import logger
+from telebot.types import Update
+
+import config
+
+# Режим webhook включается WEBHOOK_ENABLED. Если WEBHOOK_URL не задан, сервер
+# только слушает порт - так удобно проверять локально, отправляя сохранённые
+# обновления. WEBHOOK_SECRET обязателен: без него любой, кто найдёт адрес,
+# сможет прислать обновление от имени администратора.
+#   curl -X POST -H "X-Telegram-Bot-Api-Secret-Token: <WEBHOOK_SECRET>" \
+#        -d @update.json http://127.0.0.1:8443/webhook
+WEBHOOK_ENABLED = getattr(config, "WEBHOOK_ENABLED", False)
+WEBHOOK_URL = getattr(config, "WEBHOOK_URL", None)
+WEBHOOK_HOST = getattr(config, "WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = getattr(config, "WEBHOOK_PORT", 8443)
+WEBHOOK_PATH = getattr(config, "WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = getattr(config, "WEBHOOK_SECRET", None)
+WEBHOOK_SSL_CERT = getattr(config, "WEBHOOK_SSL_CERT", None)
+WEBHOOK_SSL_KEY = getattr(config, "WEBHOOK_SSL_KEY", None)
+WEBHOOK_QUEUE_SIZE = getattr(config, "WEBHOOK_QUEUE_SIZE", 1000)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, bot, host, port, path, secret, queue_size):
+        super().__init__((host, port), WebhookHandler)
+        self.bot = bot
+        self.webhook_path = path
+        self.secret = secret
+        # HTTP-ответ не ждёт обработки: обновления передаются боту по порядку
+        # из отдельного потока
+        self.updates = queue.Queue(maxsize=queue_size)
+        self.received = 0
+        self.rejected = 0
+        self.consumer = threading.Thread(
+            target=self.consume, name="webhook-consumer", daemon=True
+        )
+
+    def consume(self):
+        while True:
+            update = self.updates.get()
+            try:
+                self.bot.process_new_updates([update])
+            except Exception as e:
+                logger.error(e)
+
+    def serve_forever(self, poll_interval=0.5):
+        self.consumer.start()
+        super().serve_forever(poll_interval)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        if self.path != server.webhook_path:
+            self.send_status(404)
+            return
+        token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token.encode("utf-8"), server.secret.encode("utf-8")):
+            self.send_status(403)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            update = Update.de_json(self.rfile.read(length).decode("utf-8"))
+        except Exception as e:
+            logger.error(f"Некорректное обновление: {e}")
+            self.send_status(400)
+            return
+        try:
+            server.updates.put_nowait(update)
+        except queue.Full:
+            # Telegram повторит доставку позже
+            server.rejected += 1
+            self.send_status(503)
+            return
+        server.received += 1
+        self.send_status(200)
+
+    def send_status(self, code):
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(f"webhook {self.address_string()} {format % args}")
+
+
+def run_webhook(bot):
+    if not WEBHOOK_SECRET:
+        raise Exception("Для режима webhook нужно задать WEBHOOK_SECRET")
+    server = WebhookServer(
+        bot, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_QUEUE_SIZE
+    )
+    if WEBHOOK_SSL_CERT and WEBHOOK_SSL_KEY:
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(WEBHOOK_SSL_CERT, WEBHOOK_SSL_KEY)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    if WEBHOOK_URL:
+        bot.remove_webhook()
+        certificate = open(WEBHOOK_SSL_CERT, "rb") if WEBHOOK_SSL_CERT else None
+        try:
+            bot.set_webhook(
+                url=WEBHOOK_URL, certificate=certificate, secret_token=WEBHOOK_SECRET
+            )
+        finally:
+            if certificate is not None:
+                certificate.close()
+    logger.info(f"Webhook слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
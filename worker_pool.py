@@ -0,0 +1,88 @@
+import queue
+import threading
+
+from loguru import logger
+
+import config
+
+# 0 - обрабатывать обновления последовательно в потоке опроса
+WORKERS = getattr(config, "WORKERS", 4)
+WORKER_QUEUE_SIZE = getattr(config, "WORKER_QUEUE_SIZE", 100)
+WORKER_SUBMIT_TIMEOUT = getattr(config, "WORKER_SUBMIT_TIMEOUT", 5)
+
+
+class OrderedWorkerPool:
+    # Задачи с одним ключом (id пользователя) всегда попадают в одну очередь
+    # и выполняются одним потоком по порядку, разные пользователи - параллельно
+    def __init__(self, workers, queue_size, submit_timeout):
+        self.submit_timeout = submit_timeout
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.threads = []
+        self._lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_depth = 0
+
+    def start(self):
+        for index, tasks in enumerate(self.queues):
+            thread = threading.Thread(
+                target=self._run, args=(tasks,), name=f"worker-{index}", daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, key, function, *args, **kwargs):
+        tasks = self.queues[hash(key) % len(self.queues)]
+        try:
+            tasks.put((function, args, kwargs), timeout=self.submit_timeout)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            logger.error(f"Очередь обработки переполнена, обновление от {key} отброшено")
+            return False
+        depth = tasks.qsize()
+        with self._lock:
+            self.max_depth = max(self.max_depth, depth)
+        return True
+
+    def _run(self, tasks):
+        while True:
+            task = tasks.get()
+            if task is None:
+                tasks.task_done()
+                return
+            function, args, kwargs = task
+            try:
+                function(*args, **kwargs)
+                with self._lock:
+                    self.processed += 1
+            except Exception as e:
+                logger.error(e)
+                with self._lock:
+                    self.failed += 1
+            finally:
+                tasks.task_done()
+
+    def stop(self):
+        for tasks in self.queues:
+            tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": len(self.queues),
+                "queue_depth": [tasks.qsize() for tasks in self.queues],
+                "max_queue_depth": self.max_depth,
+                "processed": self.processed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+            }
+
+
+def create_worker_pool():
+    if not WORKERS:
+        return None
+    return OrderedWorkerPool(WORKERS, WORKER_QUEUE_SIZE, WORKER_SUBMIT_TIMEOUT)